@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per call overhead of the DefaultConnection and PushLogger
+decorators compared to the previous implementation based upon
+inspect.getcallargs and functools.partial.
+
+    python benchmarks/bench_decorators.py
+"""
+import inspect
+import os
+import sys
+import timeit
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'django_scarface.settings.unit_tests')
+
+import django
+
+django.setup()
+
+from django.test import override_settings
+
+from scarface.utils import Decorator, DefaultConnection, PushLogger, \
+    connection_manager, logging_enabled
+
+NUMBER = 100000
+
+
+class LegacyDefaultConnection(Decorator):
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.function
+        return partial(self, obj)
+
+    def __call__(self, *args, **kwargs):
+        connection_keyword = 'connection'
+        if len(args) + len(kwargs) == 0:
+            call_kwargs = dict()
+        else:
+            call_kwargs = inspect.getcallargs(
+                self.original_function,
+                *args,
+                **kwargs
+            )
+        if not call_kwargs.get(connection_keyword, None):
+            with connection_manager.connection() as connection:
+                call_kwargs[connection_keyword] = connection
+                return self.function(**call_kwargs)
+        return self.function(**call_kwargs)
+
+
+class LegacyPushLogger(Decorator):
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.function
+        self.obj = obj
+        return partial(self, obj)
+
+    def __call__(self, *args, **kwargs):
+        call_kwargs = inspect.getcallargs(self.original_function, *args,
+                                          **kwargs)
+        push_message = call_kwargs.get('push_message')
+        self.obj.sign(push_message)
+        if logging_enabled():
+            push_message.save()
+        return self.function(*args, **kwargs)
+
+
+class Message(object):
+    receiver_arn = None
+
+    def save(self):
+        pass
+
+
+class Device(object):
+    arn = 'arn'
+
+    def sign(self, push_message):
+        push_message.receiver_arn = self.arn
+
+    def send(self, push_message, connection=None):
+        return connection
+
+    legacy_send = LegacyPushLogger(LegacyDefaultConnection(send))
+    new_send = PushLogger(DefaultConnection(send))
+
+
+def run(label, statement):
+    seconds = min(timeit.repeat(statement, number=NUMBER, repeat=5))
+    print('{0:<40} {1:8.3f} us/call'.format(label, seconds / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    device = Device()
+    message = Message()
+    connection = object()
+    connection_manager.factory = lambda *key: object()
+
+    with override_settings(AWS_ACCESS_KEY='', AWS_SECRET_ACCESS_KEY=''):
+        run('plain method',
+            lambda: device.send(message, connection=connection))
+        run('legacy, explicit connection',
+            lambda: device.legacy_send(message, connection=connection))
+        run('new, explicit connection',
+            lambda: device.new_send(message, connection=connection))
+        run('legacy, pooled connection',
+            lambda: device.legacy_send(message))
+        run('new, pooled connection',
+            lambda: device.new_send(message))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the JSON backends on APNS and GCM payloads, formatted the way
+Device.send builds them: the platform payload is encoded and embedded as
+string into the encoded SNS message.
+
+    python benchmarks/bench_json.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'django_scarface.settings.unit_tests')
+
+import django
+
+django.setup()
+
+from django.test import override_settings
+
+from scarface.models import PushMessage
+from scarface.platform_strategy import APNPlatformStrategy, \
+    GCMPlatformStrategy
+from scarface.serialization import dumps
+
+NUMBER = 20000
+
+BACKENDS = (
+    ('json.dumps', 'json.dumps, default separators'),
+    ('json', 'json backend'),
+    ('orjson', 'orjson backend'),
+)
+
+
+class Platform(object):
+    def __init__(self, platform):
+        self.platform = platform
+
+
+def send(strategy, message):
+    return dumps(strategy.format_payload(message))
+
+
+def run(label, statement):
+    seconds = min(timeit.repeat(statement, number=NUMBER, repeat=5))
+    print('{0:<40} {1:8.3f} us/call'.format(label, seconds / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    message = PushMessage(
+        message=u'Neue Nachricht von Zoë: Treffen wir uns morgen um 10?',
+        context='chat',
+        context_id='4711',
+        badge_count=3,
+        sound='default',
+        extra_payload={
+            'thread': 'a2f8c0d6-1c3a-4a8e-9d63-5b1b2a7d0e11',
+            'sender': u'Zoë',
+            'avatar': 'https://example.com/avatars/42.png',
+        }
+    )
+    strategies = (
+        ('APNS', APNPlatformStrategy(Platform('APNS'))),
+        ('GCM', GCMPlatformStrategy(Platform('GCM'))),
+    )
+    for name, strategy in strategies:
+        print(name)
+        for backend, label in BACKENDS:
+            try:
+                with override_settings(SCARFACE_JSON_BACKEND=backend):
+                    dumps({})
+                    run('  ' + label, lambda: send(strategy, message))
+            except ImportError:
+                print('  {0} is not installed'.format(backend))
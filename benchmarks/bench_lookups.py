@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Compares arn and push token lookups on a seeded device table with and
+without the indexes of migration 0005.
+
+    python benchmarks/bench_lookups.py [number of devices]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'django_scarface.settings.unit_tests')
+
+import django
+
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection
+
+from scarface.models import Application, Platform, Device
+from scarface.utils import chunked
+
+DEVICES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+LOOKUPS = 200
+
+
+def seed():
+    call_command('migrate', verbosity=0)
+    application = Application.objects.create(name='benchmark')
+    platform = Platform.objects.create(
+        platform='GCM',
+        application=application,
+        arn='benchmark_platform'
+    )
+    devices = (
+        Device(
+            device_id=str(i),
+            platform=platform,
+            push_token='token_{0}'.format(i),
+            arn='arn_{0}'.format(i)
+        ) for i in range(DEVICES)
+    )
+    for chunk in chunked(devices, 5000):
+        Device.objects.bulk_create(chunk)
+    return platform
+
+
+def drop_indexes():
+    indexed = Device._meta.get_field('arn')
+    plain = indexed.clone()
+    plain.db_index = False
+    plain.set_attributes_from_name('arn')
+    plain.model = Device
+    with connection.schema_editor() as editor:
+        editor.alter_field(Device, indexed, plain)
+        for index in Device._meta.indexes:
+            editor.remove_index(Device, index)
+
+
+def run(label, platform):
+    arns = ['arn_{0}'.format(random.randrange(DEVICES))
+            for _ in range(LOOKUPS)]
+    tokens = ['token_{0}'.format(random.randrange(DEVICES))
+              for _ in range(LOOKUPS)]
+
+    def by_arns():
+        for chunk in chunked(arns, 100):
+            list(Device.objects.by_arns(chunk))
+
+    def by_token():
+        for token in tokens:
+            list(Device.objects.by_token(platform, token))
+
+    print(Device.objects.by_token(platform, tokens[0]).explain())
+    for name, statement in (('by_arns', by_arns), ('by_token', by_token)):
+        seconds = min(timeit.repeat(statement, number=1, repeat=3))
+        print('{0:<20} {1:<10} {2:10.3f} ms per {3} lookups'.format(
+            label, name, seconds * 1000, LOOKUPS
+        ))
+
+
+if __name__ == '__main__':
+    platform = seed()
+    print('{0} devices'.format(DEVICES))
+    run('with indexes', platform)
+    drop_indexes()
+    run('without indexes', platform)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the previous message trimming based upon sys.getsizeof with the
+byte accurate trimming for long multi-byte messages, and measures how long
+an oversized APNS payload takes to be fitted into max_payload_bytes.
+
+    python benchmarks/bench_trim.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'django_scarface.settings.unit_tests')
+
+import django
+
+django.setup()
+
+from django.test import override_settings
+
+from scarface.models import PushMessage
+from scarface.platform_strategy import APNPlatformStrategy, truncate_utf8
+
+NUMBER = 20
+
+
+def legacy_trim_message(message, trim_length):
+    if sys.getsizeof(message) > trim_length:
+        while sys.getsizeof(message) > trim_length:
+            message = message[:-3]
+        message += '...'
+    return message
+
+
+class Platform(object):
+    platform = 'APNS'
+
+
+def run(label, statement):
+    seconds = min(timeit.repeat(statement, number=NUMBER, repeat=3))
+    print('{0:<40} {1:10.3f} ms/call'.format(label, seconds / NUMBER * 1e3))
+
+
+if __name__ == '__main__':
+    strategy = APNPlatformStrategy(Platform())
+    for length in (1000, 10000, 100000):
+        message = u'Grüße aus Zürich \U0001F600 ' * (length // 20)
+        print('{0} characters'.format(len(message)))
+        run('  legacy trim to 140',
+            lambda: legacy_trim_message(message, 140))
+        run('  truncate_utf8 to 140 bytes',
+            lambda: truncate_utf8(message, 140))
+        push_message = PushMessage(message=message)
+        with override_settings(SCARFACE_MESSAGE_TRIM_LENGTH=10 ** 6):
+            run('  fit APNS payload into 4096 bytes',
+                lambda: strategy.format_payload(push_message))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio support. boto does not offer a non-blocking transport, therefore
+the blocking calls run on a dedicated thread pool while the event loop
+keeps serving other tasks.
+"""
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from scarface.utils import async_max_concurrency
+
+__author__ = 'dreipol GmbH'
+
+_lock = threading.Lock()
+_executor = None
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=async_max_concurrency()
+            )
+        return _executor
+
+
+def get_semaphore(loop):
+    with _lock:
+        semaphore = _semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _semaphores[loop] = asyncio.Semaphore(
+                async_max_concurrency()
+            )
+        return semaphore
+
+
+def _call(func):
+    # Like for a request, stale database connections of the worker thread
+    # are dropped before and after every call.
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Awaits the blocking func(*args, **kwargs) on the scarface executor.
+    At most SCARFACE_ASYNC_MAX_CONCURRENCY calls per event loop are in
+    flight, further calls wait without blocking the loop.
+    """
+    loop = asyncio.get_event_loop()
+    async with get_semaphore(loop):
+        return await loop.run_in_executor(
+            get_executor(),
+            partial(_call, partial(func, *args, **kwargs))
+        )
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'SCARFACE_ASYNC_MAX_CONCURRENCY':
+        with _lock:
+            executor, _executor = _executor, None
+            _semaphores.clear()
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Per process cache of the applications with their platforms and topics.
+Sending to a topic or looking up a platform doesn't query the database
+once the application is cached. Saving or deleting an application,
+platform or topic drops the cached application of this process, other
+processes reload it after SCARFACE_APPLICATION_CACHE_TIMEOUT seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from scarface.settings import SCARFACE_DEFAULT_APPLICATION_CACHE_TIMEOUT
+
+__author__ = 'dreipol GmbH'
+
+
+def application_cache_timeout():
+    return getattr(
+        settings,
+        'SCARFACE_APPLICATION_CACHE_TIMEOUT',
+        SCARFACE_DEFAULT_APPLICATION_CACHE_TIMEOUT
+    )
+
+
+class CachedApplication(object):
+    """
+    Name, platforms by platform type and the topics looked up so far by
+    name of an application. The name and the platforms are loaded when they
+    are first needed.
+    """
+
+    def __init__(self, expires):
+        self.name = None
+        self.platforms = None
+        self.topics = dict()
+        self.expires = expires
+
+
+class ApplicationCache(object):
+    """
+    The cached instances are shared, don't modify them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._applications = dict()
+
+    def get(self, application_id):
+        """
+        :rtype: CachedApplication
+        """
+        timeout = application_cache_timeout()
+        with self._lock:
+            cached = self._applications.get(application_id)
+            if cached is not None and (cached.expires is None or
+                                       cached.expires > time.monotonic()):
+                return cached
+            expires = time.monotonic() + timeout \
+                if timeout is not None else None
+            cached = CachedApplication(expires)
+            if timeout != 0:
+                self._applications[application_id] = cached
+            return cached
+
+    def name(self, application_id):
+        from scarface.models import Application
+
+        cached = self.get(application_id)
+        if cached.name is None:
+            cached.name = Application.objects.filter(
+                pk=application_id).values_list('name', flat=True).get()
+        return cached.name
+
+    def platforms(self, application_id):
+        """
+        :return: dict of platform type to Platform
+        """
+        from scarface.models import Platform
+
+        cached = self.get(application_id)
+        if cached.platforms is None:
+            cached.platforms = dict(
+                (platform.platform, platform) for platform in
+                Platform.objects.filter(application_id=application_id)
+            )
+        return cached.platforms
+
+    def topic(self, application_id, name):
+        """
+        :raise Topic.DoesNotExist
+        """
+        from scarface.models import Topic
+
+        cached = self.get(application_id)
+        topic = cached.topics.get(name)
+        if topic is None:
+            topic = Topic.objects.get(application_id=application_id,
+                                      name=name)
+            cached.topics[name] = topic
+        return topic
+
+    def invalidate(self, application_id=None):
+        """
+        Drops an application or, without an argument, all of them.
+        """
+        with self._lock:
+            if application_id is None:
+                self._applications.clear()
+            else:
+                self._applications.pop(application_id, None)
+
+
+application_cache = ApplicationCache()
+
+
+@receiver(setting_changed)
+def reset_application_cache(setting, **kwargs):
+    if setting == 'SCARFACE_APPLICATION_CACHE_TIMEOUT':
+        application_cache.invalidate()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from scarface.circuit_breaker import get_breaker
+from scarface.exceptions import BaseScarfaceException, \
+    NotRegisteredException
+from scarface.utils import connection_manager, logging_enabled, chunked, \
+    bulk_chunk_size, bulk_max_workers
+
+__author__ = 'dreipol GmbH'
+
+class DeliveryResult(namedtuple('DeliveryResult',
+                                ['device_pk', 'arn', 'response', 'error'])):
+    """
+    Outcome of a single publish within a bulk send.
+    """
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+def _call(func, item, connection):
+    try:
+        if connection:
+            return func(item, connection), None
+        # boto connections are not thread safe, every call checks out its
+        # own pooled connection.
+        with connection_manager.connection() as connection:
+            return func(item, connection), None
+    except Exception as err:
+        return None, err
+
+
+def run_concurrently(func, items, connection=None, chunk_size=None,
+                     max_workers=None):
+    """
+    Calls func(item, connection) for every item on a bounded thread pool.
+    Items are consumed chunk by chunk so that at most chunk_size calls are
+    in flight or buffered at any time.
+
+    :param connection: the connection which should be used. boto connections
+    aren't thread safe, so the calls run one after the other on a single
+    worker. If the argument isn't set every call uses a pooled default
+    connection.
+    :return: generator of (item, result, error) tuples in input order
+    """
+    chunk_size = chunk_size or bulk_chunk_size()
+    max_workers = 1 if connection else max_workers or bulk_max_workers()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk in chunked(items, chunk_size):
+            futures = [
+                executor.submit(_call, func, item, connection)
+                for item in chunk
+            ]
+            for item, future in zip(chunk, futures):
+                result, error = future.result()
+                yield item, result, error
+
+
+def send_to_devices(queryset, push_message, connection=None, chunk_size=None,
+                    max_workers=None, badges=None):
+    """
+    Sends a push message to every device of the queryset. The payload is
+    compiled once per platform and published through a bounded pool of
+    worker threads.
+
+    :type push_message: PushMessage
+    :param push_message: the message to send.
+    :param badges: dict of device primary key to badge count, or a function
+    which returns the badge count of a device primary key. Devices without
+    a badge count get the one of the message.
+    :type connection: SNSConnection
+    :param connection: the connection which should be used. If the argument
+    isn't set every publish uses a pooled default connection.
+    :return: list of DeliveryResult, one per device
+    """
+    from scarface.models import Platform, PushMessage
+
+    chunk_size = chunk_size or bulk_chunk_size()
+    payloads = dict()
+    breakers = dict()
+    slots = ()
+    get_badge = None
+    if isinstance(badges, dict):
+        slots = ('badge',)
+        get_badge = lambda device_pk: badges.get(
+            device_pk, push_message.badge_count)
+    elif badges is not None:
+        slots = ('badge',)
+        get_badge = badges
+
+    def get_payload(platform_id):
+        if platform_id not in payloads:
+            try:
+                platform = Platform.objects.get(pk=platform_id)
+                breakers[platform_id] = get_breaker(platform.arn)
+                payloads[platform_id] = platform.compile_payload(
+                    push_message, slots
+                )
+            except BaseScarfaceException as err:
+                payloads[platform_id] = err
+        return payloads[platform_id]
+
+    def publish(row, connection):
+        device_pk, platform_id, arn, badge = row
+        if get_badge is None:
+            message = payloads[platform_id].render()
+        else:
+            message = payloads[platform_id].render(badge=badge)
+        with breakers[platform_id]:
+            return connection.publish(
+                message=message,
+                target_arn=arn,
+                message_structure="json"
+            )
+
+    rows = queryset.values_list('pk', 'platform_id', 'arn').iterator(
+        chunk_size=chunk_size
+    )
+    results = list()
+
+    def registered_rows():
+        for chunk in chunked(rows, chunk_size):
+            registered = list()
+            for device_pk, platform_id, arn in chunk:
+                if not arn:
+                    results.append(DeliveryResult(
+                        device_pk, arn, None, NotRegisteredException()
+                    ))
+                    continue
+                payload = get_payload(platform_id)
+                if isinstance(payload, Exception):
+                    results.append(DeliveryResult(
+                        device_pk, arn, None, payload
+                    ))
+                else:
+                    badge = push_message.badge_count if get_badge is None \
+                        else get_badge(device_pk)
+                    registered.append((device_pk, platform_id, arn, badge))
+            if logging_enabled():
+                PushMessage.objects.bulk_create([
+                    push_message.clone(
+                        receiver_arn=arn,
+                        message_type=PushMessage.MESSAGE_TYPE_DEFAULT,
+                        badge_count=badge
+                    ) for _, _, arn, badge in registered
+                ])
+            for row in registered:
+                yield row
+
+    for row, response, error in run_concurrently(
+            publish, registered_rows(), connection, chunk_size, max_workers):
+        results.append(DeliveryResult(row[0], row[2], response, error))
+
+    return results
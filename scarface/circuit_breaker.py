@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers per platform application. When SNS rejects the platform
+itself, e.g. because it was disabled after the APNS certificate expired,
+every publish to its devices fails. After SCARFACE_CIRCUIT_BREAKER_THRESHOLD
+such failures in a row the breaker opens and publishes fail right away with
+CircuitOpenException. After SCARFACE_CIRCUIT_BREAKER_COOLDOWN seconds one
+call is let through, its outcome closes or reopens the breaker.
+"""
+import threading
+import time
+
+from boto.exception import BotoServerError
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from scarface.exceptions import CircuitOpenException
+from scarface.retry import is_retryable
+from scarface.settings import SCARFACE_DEFAULT_CIRCUIT_BREAKER_THRESHOLD, \
+    SCARFACE_DEFAULT_CIRCUIT_BREAKER_COOLDOWN
+
+__author__ = 'dreipol GmbH'
+
+PLATFORM_FAILURE_CODES = frozenset([
+    'PlatformApplicationDisabled',
+    'InvalidClientTokenId',
+    'ExpiredToken',
+    'SignatureDoesNotMatch',
+    'AuthorizationError',
+    'AccessDenied',
+    'AccessDeniedException',
+])
+
+_lock = threading.Lock()
+_breakers = dict()
+
+
+def circuit_breaker_threshold():
+    return getattr(
+        settings,
+        'SCARFACE_CIRCUIT_BREAKER_THRESHOLD',
+        SCARFACE_DEFAULT_CIRCUIT_BREAKER_THRESHOLD
+    )
+
+
+def circuit_breaker_cooldown():
+    return getattr(
+        settings,
+        'SCARFACE_CIRCUIT_BREAKER_COOLDOWN',
+        SCARFACE_DEFAULT_CIRCUIT_BREAKER_COOLDOWN
+    )
+
+
+def is_platform_failure(error):
+    """
+    Returns True if error means that the platform can't be used at all.
+    """
+    return isinstance(error, BotoServerError) and \
+        error.error_code in PLATFORM_FAILURE_CODES
+
+
+class CircuitBreaker(object):
+    """
+    Guards the calls made with the breaker as context manager. Errors which
+    only concern a single endpoint count as success, transient errors are
+    ignored.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, key, threshold=None, cooldown=None,
+                 clock=time.monotonic):
+        self.key = key
+        self.threshold = threshold or circuit_breaker_threshold()
+        self.cooldown = cooldown if cooldown is not None \
+            else circuit_breaker_cooldown()
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            if self.state == self.OPEN and \
+                    self.clock() - self.opened >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return self
+            if self.state != self.CLOSED:
+                raise CircuitOpenException(
+                    u'Circuit of {0} is {1}'.format(self.key, self.state)
+                )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            self._probing = False
+            if exc_value is not None and is_retryable(exc_value):
+                return
+            if exc_value is not None and is_platform_failure(exc_value):
+                self.failures += 1
+                if self.state == self.HALF_OPEN or \
+                        self.failures >= self.threshold:
+                    self.state = self.OPEN
+                    self.opened = self.clock()
+            else:
+                self.state = self.CLOSED
+                self.failures = 0
+
+
+def get_breaker(key):
+    """
+    Returns the circuit breaker of a platform arn.
+    :rtype: CircuitBreaker
+    """
+    with _lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(key)
+        return _breakers[key]
+
+
+@receiver(setting_changed)
+def reset_breakers(setting, **kwargs):
+    if setting in ('SCARFACE_CIRCUIT_BREAKER_THRESHOLD',
+                   'SCARFACE_CIRCUIT_BREAKER_COOLDOWN'):
+        with _lock:
+            _breakers.clear()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+The SNS connection class handed out by the connection pool.
+"""
+import logging
+import time
+
+from boto.sns.connection import SNSConnection
+
+from scarface.retry import is_retryable, backoff, retry_max_attempts
+from scarface.throttling import throttle
+
+__author__ = 'dreipol GmbH'
+
+logger = logging.getLogger('django_scarface')
+
+
+class _ConnectionError(Exception):
+    pass
+
+
+class ScarfaceSNSConnection(SNSConnection):
+    """
+    SNSConnection which waits for the rate limit of each API action, see
+    SCARFACE_RATE_LIMITS, and retries transient errors up to
+    SCARFACE_RETRY_MAX_ATTEMPTS times. The retries of boto itself are
+    turned off, each attempt is a single HTTP request.
+    """
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        try:
+            return super(ScarfaceSNSConnection, self)._mexe(
+                request, self._send, 0, self._check_response
+            )
+        except _ConnectionError as error:
+            raise error.args[0]
+
+    def _send(self, connection, method, path, body, headers):
+        # boto sleeps before it gives up on a connection error, even
+        # without retries
+        try:
+            connection.request(method, path, body, headers)
+            return connection.getresponse()
+        except self.http_exceptions as error:
+            raise _ConnectionError(error)
+
+    def _check_response(self, response, i, next_sleep):
+        # Same for server errors
+        if response.status >= 500:
+            body = response.read()
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            raise self.ResponseError(response.status, response.reason, body)
+
+    def _make_request(self, action, params, path='/', verb='GET'):
+        attempt = 1
+        while True:
+            throttle(self.region.name, action)
+            try:
+                return super(ScarfaceSNSConnection, self)._make_request(
+                    action, dict(params), path, verb
+                )
+            except Exception as error:
+                if attempt >= retry_max_attempts() or \
+                        not is_retryable(error):
+                    raise
+                delay = backoff(attempt)
+                logger.info(u'{0} failed with {1!r}, retry in {2:.2f}s'.format(
+                    action, error, delay
+                ))
+                time.sleep(delay)
+                attempt += 1
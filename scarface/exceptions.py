@@ -17,3 +17,9 @@ class NotRegisteredException(BaseScarfaceException):
 
 
 
+
+class CircuitOpenException(SNSException):
+    message = "The platform failed repeatedly, calls are suspended"
+
+class PayloadTooLarge(BaseScarfaceException):
+    message = "The payload exceeds the size limit of the platform"
@@ -0,0 +1,28 @@
+# coding=utf8
+__author__ = 'dreipol GmbH'
+
+from django.core.management.base import BaseCommand
+
+from scarface.push_log import purge
+
+
+class Command(BaseCommand):
+    help = 'Deletes the logged push messages older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--days',
+                            action='store',
+                            dest='days',
+                            type=int,
+                            help='Keep the messages of this many days, '
+                                 'defaults to SCARFACE_LOG_RETENTION_DAYS')
+        parser.add_argument('--chunk-size',
+                            action='store',
+                            dest='chunk_size',
+                            type=int,
+                            default=1000,
+                            help='Number of primary keys per delete')
+
+    def handle(self, *args, **options):
+        deleted = purge(options['days'], options['chunk_size'])
+        self.stdout.write('Deleted {0} push messages'.format(deleted))
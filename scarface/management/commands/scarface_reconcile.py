@@ -0,0 +1,52 @@
+# coding=utf8
+__author__ = 'dreipol GmbH'
+
+from django.core.management.base import BaseCommand, CommandError
+
+from scarface.models import Application
+from scarface.reconcile import reconcile_platform, reconcile_topic
+
+
+class Command(BaseCommand):
+    help = 'Compares the local devices and subscriptions with the ones in SNS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-a', '--application',
+                            action='store',
+                            dest='application',
+                            type=str,
+                            help='Only reconcile this application')
+        parser.add_argument('--apply',
+                            action='store_true',
+                            dest='apply',
+                            help='Fix the local devices and subscriptions')
+        parser.add_argument('--delete-orphans',
+                            action='store_true',
+                            dest='delete_orphans',
+                            help='Delete the endpoints and subscriptions '
+                                 'in SNS which have no local counterpart')
+        parser.add_argument('--chunk-size',
+                            action='store',
+                            dest='chunk_size',
+                            type=int,
+                            help='Number of arns matched per query')
+
+    def handle(self, *args, **options):
+        applications = Application.objects.all()
+        if options['application']:
+            applications = applications.filter(name=options['application'])
+            if not applications.exists():
+                raise CommandError(u'Application "{0}" does not exist'.format(
+                    options['application']
+                ))
+
+        kwargs = dict(
+            apply=options['apply'],
+            delete_orphans=options['delete_orphans'],
+            chunk_size=options['chunk_size']
+        )
+        for application in applications:
+            for platform in application.platforms.exclude(arn__isnull=True):
+                self.stdout.write(str(reconcile_platform(platform, **kwargs)))
+            for topic in application.topics.exclude(arn__isnull=True):
+                self.stdout.write(str(reconcile_topic(topic, **kwargs)))
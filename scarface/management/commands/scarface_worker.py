@@ -0,0 +1,51 @@
+# coding=utf8
+__author__ = 'dreipol GmbH'
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from scarface.outbox import process
+
+
+class Command(BaseCommand):
+    help = 'Sends the push messages queued with enqueue()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size',
+                            action='store',
+                            dest='batch_size',
+                            type=int,
+                            default=100,
+                            help='Number of messages claimed at once')
+        parser.add_argument('-w', '--max-workers',
+                            action='store',
+                            dest='max_workers',
+                            type=int,
+                            help='Number of threads which send concurrently')
+        parser.add_argument('-s', '--sleep',
+                            action='store',
+                            dest='sleep',
+                            type=float,
+                            default=1.0,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once',
+                            action='store_true',
+                            dest='once',
+                            help='Stop as soon as the outbox is empty')
+
+    def handle(self, *args, **options):
+        total = 0
+        try:
+            while True:
+                claimed = process(options['batch_size'],
+                                  max_workers=options['max_workers'])
+                total += claimed
+                if claimed:
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('Processed {0} push messages'.format(total))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scarface', '0004_auto_20151217_1131'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='device',
+            name='arn',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='arn',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='topic',
+            name='arn',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['push_token', 'platform'], name='scarface_device_token_idx'),
+        ),
+    ]
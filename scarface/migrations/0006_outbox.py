@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scarface', '0005_arn_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushmessage',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pushmessage',
+            name='last_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pushmessage',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pushmessage',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'logged'), (1, 'queued'), (2, 'sent'), (3, 'failed')], default=0),
+        ),
+        migrations.AddIndex(
+            model_name='pushmessage',
+            index=models.Index(fields=['status', 'next_attempt'], name='scarface_pushmessage_outbox'),
+        ),
+    ]
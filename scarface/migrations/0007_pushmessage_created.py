@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scarface', '0006_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushmessage',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
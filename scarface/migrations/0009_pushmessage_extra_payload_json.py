@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import scarface.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scarface', '0008_pushmessage_collapse_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pushmessage',
+            name='extra_payload',
+            field=scarface.models.JSONTextField(blank=True, null=True),
+        ),
+    ]
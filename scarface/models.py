@@ -1,11 +1,18 @@
+import copy
+import json
 import logging
 from abc import abstractmethod, abstractproperty
-import json
 from boto.exception import BotoServerError
 import re
 from django.db import models
+from django.utils import timezone
+from scarface.aio import run_sync
+from scarface.application_cache import application_cache
+from scarface.circuit_breaker import get_breaker
+from scarface.payload_cache import payload_cache
 from scarface.platform_strategy import get_strategies
-from scarface.utils import DefaultConnection, PushLogger
+from scarface.utils import DefaultConnection, PushLogger, chunked, \
+    bulk_chunk_size, chunked_by_pk
 from scarface.exceptions import SNSNotCreatedException, PlatformNotSupported, \
     SNSException, NotRegisteredException
 
@@ -13,6 +20,50 @@ from scarface.exceptions import SNSNotCreatedException, PlatformNotSupported, \
 logger = logging.getLogger('django_scarface')
 
 
+ENDPOINT_EXISTS_RE = re.compile(r'Endpoint(.*)already', re.IGNORECASE)
+
+
+class JSONTextField(models.TextField):
+    """
+    Text column which stores its value as JSON. Values which aren't valid
+    JSON, e.g. rows saved before, are read as they are.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if not isinstance(value, str):
+            return value
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return json.dumps(value)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self.value_from_object(obj))
+
+
+def existing_endpoint_arn(err):
+    """
+    Extracts the arn of the existing endpoint from the error SNS returns
+    when an endpoint with the same token already exists.
+    Heavily inspired by http://stackoverflow.com/a/28316993/270265
+    :type err: BotoServerError
+    :return: the arn or None
+    """
+    result = ENDPOINT_EXISTS_RE.search(err.message or '')
+    if result:
+        return result.group(0).replace('Endpoint ', '').replace(
+            ' already', '')
+    return None
+
+
 class SNSCRUDMixin(object):
 
     @abstractproperty
@@ -102,9 +153,9 @@ class Application(models.Model):
 
     def get_topic(self, name):
         '''
-        Returns a topic by its name.
+        Returns a topic by its name. It is a copy of the cached topic.
         '''
-        return self.topics.get(name=name)
+        return copy.copy(application_cache.topic(self.pk, name))
 
     def get_or_create_topic(self, name):
         '''
@@ -126,11 +177,43 @@ class Application(models.Model):
             return topic, True
 
     def get_platform(self, platform_type):
-
+        '''
+        Returns a platform by its type. It is a copy of the cached platform.
+        '''
         try:
-            return self.platforms.get(platform=platform_type)
-        except Platform.DoesNotExist:
+            platform = application_cache.platforms(self.pk)[platform_type]
+        except KeyError:
             raise PlatformNotSupported
+        return copy.copy(platform)
+
+
+class ArnQuerySet(models.QuerySet):
+
+    def by_arns(self, arns):
+        """
+        Returns the instances with the given arns. The lookup uses the arn
+        index, pass the arns in chunks if there are many of them.
+        """
+        return self.filter(arn__in=list(arns))
+
+
+class DeviceQuerySet(ArnQuerySet):
+
+    def by_token(self, platform, token):
+        """
+        Returns the devices of a platform with the given push token.
+        """
+        return self.filter(platform=platform, push_token=token)
+
+    def send(self, push_message, connection=None, **kwargs):
+        """
+        Sends the push message to all devices of this queryset.
+        See scarface.bulk.send_to_devices for the available arguments.
+        :return: list of DeliveryResult, one per device
+        """
+        from scarface.bulk import send_to_devices
+        return send_to_devices(self, push_message, connection=connection,
+                               **kwargs)
 
 
 class Device(SNSCRUDMixin, models.Model):
@@ -152,7 +235,8 @@ class Device(SNSCRUDMixin, models.Model):
     arn = models.CharField(
         max_length=255,
         null=True,
-        blank=True
+        blank=True,
+        db_index=True
     )
 
     push_token = models.CharField(
@@ -164,8 +248,14 @@ class Device(SNSCRUDMixin, models.Model):
         through='Subscription'
     )
 
+    objects = DeviceQuerySet.as_manager()
+
     class Meta:
         unique_together = (('device_id', 'platform'))
+        indexes = [
+            models.Index(fields=['push_token', 'platform'],
+                         name='scarface_device_token_idx'),
+        ]
 
     @property
     def resource_name(self):
@@ -207,14 +297,10 @@ class Device(SNSCRUDMixin, models.Model):
         else:
             try:
                 result = self.register(custom_user_data, connection)
-            # Heavily inspired by http://stackoverflow.com/a/28316993/270265
             except BotoServerError as err:
-                result_re = re.compile(r'Endpoint(.*)already', re.IGNORECASE)
-                result = result_re.search(err.message)
+                result = existing_endpoint_arn(err)
                 if result:
-                    arn = result.group(0).replace('Endpoint ', '').replace(
-                        ' already', '')
-                    self.arn = arn
+                    self.arn = result
                     self.update(new_token, custom_user_data, connection)
                 else:
                     sns_exc = SNSNotCreatedException(err)
@@ -223,6 +309,14 @@ class Device(SNSCRUDMixin, models.Model):
 
         return result
 
+    async def aregister_or_update(self, new_token=None, custom_user_data=u"",
+                                  connection=None):
+        """
+        Awaitable version of register_or_update().
+        """
+        return await run_sync(self.register_or_update, new_token,
+                              custom_user_data, connection=connection)
+
     @DefaultConnection
     def deregister(self, connection=None, save=True):
         """
@@ -260,15 +354,38 @@ class Device(SNSCRUDMixin, models.Model):
         if the argument isn't set there will be created a default connection
         :return:
         """
+        return self.publish(push_message, connection)
+
+    def enqueue(self, push_message):
+        """
+        Stores the push message in the outbox. It is sent by the
+        scarface_worker command.
+        """
         if not self.is_registered:
             raise NotRegisteredException
-        push_message = self.platform.format_payload(push_message)
-        json_string = json.dumps(push_message)
-        return connection.publish(
-            message=json_string,
-            target_arn=self.arn,
-            message_structure="json"
-        )
+        self.sign(push_message)
+        push_message.enqueue()
+
+    @DefaultConnection
+    def publish(self, push_message, connection=None):
+        """
+        Sends the push message without logging it.
+        """
+        if not self.is_registered:
+            raise NotRegisteredException
+        payload, json_string = payload_cache.get(self.platform, push_message)
+        with get_breaker(self.platform.arn):
+            return connection.publish(
+                message=json_string,
+                target_arn=self.arn,
+                message_structure="json"
+            )
+
+    async def asend(self, push_message, connection=None):
+        """
+        Awaitable version of send().
+        """
+        return await run_sync(self.send, push_message, connection=connection)
 
     @DefaultConnection
     def update(self, new_token=None, custom_user_data=u"", connection=None):
@@ -292,7 +409,7 @@ class Device(SNSCRUDMixin, models.Model):
 
     def sign(self, push_message):
         push_message.receiver_arn = self.arn
-        push_message.message_type = PushMessage.MESSAGE_TYPE_TOPIC
+        push_message.message_type = PushMessage.MESSAGE_TYPE_DEFAULT
 
 
 class Platform(SNSCRUDMixin, models.Model):
@@ -332,13 +449,22 @@ class Platform(SNSCRUDMixin, models.Model):
 
     @property
     def app_name(self):
-        return self.application.name
+        return application_cache.name(self.application_id)
 
     @property
     def strategy(self):
+        """
+        The strategy instance is cached as long as neither the platform nor
+        the registered strategies change.
+        """
         strategies = get_strategies()
+        cached = getattr(self, '_strategy', None)
+        if cached and cached[0] is strategies and cached[1] == self.platform:
+            return cached[2]
         if self.platform in strategies.keys():
-            return strategies[self.platform](self)
+            strategy = strategies[self.platform](self)
+            self._strategy = (strategies, self.platform, strategy)
+            return strategy
         else:
             raise PlatformNotSupported
 
@@ -410,34 +536,158 @@ class Platform(SNSCRUDMixin, models.Model):
         :param connection:
         :return: List of Devices associated with this platform
         """
-        endpoint_arns = list()
+        return list(self.iter_devices(connection))
+
+    @DefaultConnection
+    def iter_devices(self, connection=None, chunk_size=None):
+        """
+        Yields the devices which are registered with this platform page by
+        page. Every page of endpoints is matched against the database in
+        chunks of at most chunk_size arns, so the memory usage does not
+        depend on the number of endpoints.
 
-        def get_next(nexttoken):
+        :param connection:
+        :return: generator of Devices associated with this platform
+        """
+        chunk_size = chunk_size or bulk_chunk_size()
+        for endpoints in self.iter_endpoint_pages(connection):
+            endpoint_arns = [endpoint['EndpointArn'] for endpoint in endpoints]
+            for chunk in chunked(endpoint_arns, chunk_size):
+                for device in Device.objects.by_arns(chunk):
+                    yield device
+
+    @DefaultConnection
+    def iter_endpoint_pages(self, connection=None):
+        """
+        Yields the endpoints of this platform as returned by SNS, one list
+        per page.
+
+        :param connection:
+        :return: generator of lists of endpoint dicts
+        """
+        next_token = None
+        while True:
             response = connection.list_endpoints_by_platform_application(
                 platform_application_arn=self.arn,
-                next_token=nexttoken)
+                next_token=next_token)
             result = response[u'ListEndpointsByPlatformApplicationResponse'][
                 u'ListEndpointsByPlatformApplicationResult']
-            endpoints = result[u'Endpoints']
-            for endpoint in endpoints:
-                endpoint_arns.append(
-                    endpoint['EndpointArn']
-                )
-
-            return result[u'NextToken']
+            yield result[u'Endpoints']
+            next_token = result[u'NextToken']
+            if not next_token:
+                return
 
-        next_token = get_next(None)
+    def register_devices(self, devices_or_tokens, custom_user_data=u"",
+                         connection=None, chunk_size=None, max_workers=None):
+        """
+        Registers many devices to SNS at once. The endpoints are created
+        concurrently and the arns are written back with one bulk update per
+        chunk. Devices which are already registered, or whose endpoint
+        already exists, are updated like in Device.register_or_update.
+
+        :param devices_or_tokens: Device instances of this platform or
+        (device_id, push_token) tuples. Devices which don't exist yet are
+        created.
+        :type connection: SNSConnection
+        :param connection: the connection which should be used. If the argument
+        isn't set every call uses a pooled default connection.
+        :return: list of DeliveryResult, one per device
+        """
+        from scarface.bulk import DeliveryResult, run_concurrently
 
-        while next_token:
-            next_token = get_next(next_token)
+        chunk_size = chunk_size or bulk_chunk_size()
+        if not self.is_registered:
+            self.register(connection)
+            self.save()
 
-        devices_list = list(Device.objects.filter(arn__in=endpoint_arns))
+        def register(device, connection):
+            if device.is_registered:
+                return device.update(None, custom_user_data, connection)
+            try:
+                response = connection.create_platform_endpoint(
+                    self.arn,
+                    device.push_token,
+                    custom_user_data=custom_user_data
+                )
+            except BotoServerError as err:
+                arn = existing_endpoint_arn(err)
+                if not arn:
+                    sns_exc = SNSNotCreatedException(err)
+                    sns_exc.message = err.message
+                    raise sns_exc
+                device.arn = arn
+                return device.update(None, custom_user_data, connection)
+            if not device.set_arn_from_response(response):
+                raise SNSException(
+                    'Failed to register Device.({0})'.format(response)
+                )
+            return response
+
+        results = list()
+        for chunk in chunked(devices_or_tokens, chunk_size):
+            devices = self._get_or_create_devices(chunk)
+            registered = list()
+            for device, response, error in run_concurrently(
+                    register, devices, connection, chunk_size, max_workers):
+                results.append(
+                    DeliveryResult(device.pk, device.arn, response, error)
+                )
+                if error is None:
+                    registered.append(device)
+            Device.objects.bulk_update(registered, ['arn', 'push_token'])
+        return results
 
-        return devices_list
+    def _get_or_create_devices(self, devices_or_tokens):
+        """
+        Returns saved devices of this platform for a chunk of Device
+        instances or (device_id, push_token) tuples.
+        """
+        devices = list()
+        tokens = dict()
+        for item in devices_or_tokens:
+            if isinstance(item, Device) and item.pk:
+                devices.append(item)
+            elif isinstance(item, Device):
+                tokens[item.device_id] = item.push_token
+            else:
+                device_id, push_token = item
+                tokens[device_id] = push_token
+        if not tokens:
+            return devices
+
+        existing = self.devices.filter(device_id__in=tokens.keys())
+        for device in existing:
+            device.push_token = tokens.pop(device.device_id)
+            devices.append(device)
+        Device.objects.bulk_create([
+            Device(device_id=device_id, push_token=push_token, platform=self)
+            for device_id, push_token in tokens.items()
+        ])
+        devices.extend(self.devices.filter(device_id__in=tokens.keys()))
+        return devices
+
+    async def aall_devices(self, connection=None):
+        """
+        Awaitable version of all_devices().
+        """
+        return await run_sync(self.all_devices, connection=connection)
 
-    def format_payload(self, data):
+    def format_payload(self, data, digest=None):
+        """
+        :param digest: message_digest() of the message if it is known
+        already, passed on to strategies which use it.
+        """
+        if digest is not None and self.strategy.uses_digest:
+            return self.strategy.format_payload(data, digest=digest)
         return self.strategy.format_payload(data)
 
+    def compile_payload(self, push_message, slots=()):
+        """
+        Returns the SNS message for this platform as PayloadTemplate, see
+        PlatformStrategy.compile.
+        """
+        return self.strategy.compile(push_message, slots)
+
 
 class Topic(SNSCRUDMixin, models.Model):
     name = models.CharField(
@@ -451,13 +701,16 @@ class Topic(SNSCRUDMixin, models.Model):
     arn = models.CharField(
         max_length=255,
         null=True,
-        blank=True
+        blank=True,
+        db_index=True
     )
     devices = models.ManyToManyField(
         to=Device,
         through='Subscription'
     )
 
+    objects = ArnQuerySet.as_manager()
+
     class Meta:
         unique_together = (('name', 'application'))
 
@@ -467,7 +720,8 @@ class Topic(SNSCRUDMixin, models.Model):
 
     @property
     def full_name(self):
-        return '_'.join([self.application.name, self.name])
+        return '_'.join([application_cache.name(self.application_id),
+                         self.name])
 
     @DefaultConnection
     def register(self, connection=None):
@@ -515,6 +769,13 @@ class Topic(SNSCRUDMixin, models.Model):
         success = subscription.register(connection)
         return success
 
+    async def aregister_device(self, device, connection=None):
+        """
+        Awaitable version of register_device().
+        """
+        return await run_sync(self.register_device, device,
+                              connection=connection)
+
     @DefaultConnection
     def deregister_device(self, device, connection=None):
         if not device.is_registered:
@@ -531,25 +792,141 @@ class Topic(SNSCRUDMixin, models.Model):
             return False
         return True
 
+    def register_devices(self, devices, connection=None, chunk_size=None,
+                         max_workers=None):
+        """
+        Subscribes many devices to the topic at once. Missing subscriptions
+        are created with one bulk insert per chunk, the devices are
+        subscribed concurrently and the arns are written back with a bulk
+        update. Devices which are subscribed already are skipped.
+
+        :param devices: Device queryset. Register the devices first, e.g.
+        with Platform.register_devices.
+        :type connection: SNSConnection
+        :param connection: the connection which should be used. If the argument
+        isn't set every call uses a pooled default connection.
+        :return: list of DeliveryResult, one per device
+        """
+        from scarface.bulk import DeliveryResult, run_concurrently
+
+        chunk_size = chunk_size or bulk_chunk_size()
+        if not self.is_registered:
+            self.register(connection)
+            self.save()
+
+        def subscribe(subscription, connection):
+            response = connection.subscribe(
+                topic=self.arn,
+                endpoint=subscription.device.arn,
+                protocol="application"
+            )
+            if not subscription.set_arn_from_response(response):
+                raise SNSException(
+                    'Failed to subscribe device to topic.({0})'.format(
+                        response)
+                )
+            return response
+
+        results = list()
+        for chunk in chunked_by_pk(devices, chunk_size, 'arn'):
+            registered = list()
+            for device_pk, arn in chunk:
+                if arn:
+                    registered.append(device_pk)
+                else:
+                    results.append(DeliveryResult(
+                        device_pk, None, None, NotRegisteredException()
+                    ))
+            Subscription.objects.bulk_create([
+                Subscription(topic=self, device_id=device_pk)
+                for device_pk in registered
+            ], ignore_conflicts=True)
+            subscriptions = list()
+            for subscription in Subscription.objects.filter(
+                    topic=self, device_id__in=registered).select_related(
+                    'device'):
+                if subscription.is_registered:
+                    results.append(DeliveryResult(
+                        subscription.device_id, subscription.arn, None, None
+                    ))
+                else:
+                    subscriptions.append(subscription)
+
+            subscribed = list()
+            for subscription, response, error in run_concurrently(
+                    subscribe, subscriptions, connection, chunk_size,
+                    max_workers):
+                results.append(DeliveryResult(
+                    subscription.device_id, subscription.arn, response, error
+                ))
+                if error is None:
+                    subscribed.append(subscription)
+            Subscription.objects.bulk_update(subscribed, ['arn'])
+        return results
+
+    def deregister_devices(self, devices, connection=None, chunk_size=None,
+                           max_workers=None):
+        """
+        Unsubscribes many devices from the topic at once. The devices are
+        unsubscribed concurrently, then their subscriptions are deleted.
+        Subscriptions which fail to unsubscribe are kept.
+
+        :param devices: Device queryset.
+        :type connection: SNSConnection
+        :param connection: the connection which should be used. If the argument
+        isn't set every call uses a pooled default connection.
+        :return: list of DeliveryResult, one per subscription
+        """
+        from scarface.bulk import DeliveryResult, run_concurrently
+
+        chunk_size = chunk_size or bulk_chunk_size()
+        subscriptions = self.subscription_set.filter(device__in=devices)
+
+        def unsubscribe(row, connection):
+            pk, device_pk, arn = row
+            if not arn:
+                return None
+            return connection.unsubscribe(arn)
+
+        results = list()
+        for chunk in chunked_by_pk(subscriptions, chunk_size,
+                                   'device_id', 'arn'):
+            unsubscribed = list()
+            for row, response, error in run_concurrently(
+                    unsubscribe, chunk, connection, chunk_size, max_workers):
+                results.append(DeliveryResult(row[1], row[2], response, error))
+                if error is None:
+                    unsubscribed.append(row[0])
+            # Clear the arns first, so deleting doesn't unsubscribe again
+            Subscription.objects.filter(pk__in=unsubscribed).update(arn=None)
+            Subscription.objects.filter(pk__in=unsubscribed).delete()
+        return results
+
     @DefaultConnection
     def all_subscriptions(self, connection=None):
-        subscriptions_list = list()
+        return list(self.iter_subscriptions(connection))
 
-        def get_next(nexttoken):
+    @DefaultConnection
+    def iter_subscriptions(self, connection=None, start_token=None):
+        """
+        Yields the subscriptions of this topic as returned by SNS. The next
+        page is only requested once the current one has been consumed.
+
+        :param connection:
+        :param start_token: NextToken of a previous listing to resume from.
+        :return: generator of subscription dicts
+        """
+        next_token = start_token
+        while True:
             response = connection.get_all_subscriptions_by_topic(
-                topic=self.arn, next_token=nexttoken)
+                topic=self.arn, next_token=next_token)
             result = response["ListSubscriptionsByTopicResponse"][
                 "ListSubscriptionsByTopicResult"]
-            subs = result[u'Subscriptions']
-            subscriptions_list.extend(subs)
-            return result[u'NextToken']
-
-        next_token = get_next(None)
-
-        while next_token:
-            next_token = get_next(next_token)
-
-        return subscriptions_list
+            for subscription in result[u'Subscriptions']:
+                yield subscription
+            next_token = result[u'NextToken']
+            if not next_token:
+                return
 
     def sign(self, push_message):
         push_message.receiver_arn = self.arn
@@ -566,30 +943,77 @@ class Topic(SNSCRUDMixin, models.Model):
         :param platforms:
         :return:
         """
-        payload = dict()
-        for platform in self.application.platforms.all():
-            payload.update(platform.format_payload(push_message))
-        payload["default"] = push_message.message
-        json_string = json.dumps(payload)
+        return self.publish(push_message, connection)
+
+    def enqueue(self, push_message):
+        """
+        Stores the push message in the outbox. It is sent by the
+        scarface_worker command.
+        """
+        if not self.is_registered:
+            raise NotRegisteredException
+        self.sign(push_message)
+        push_message.enqueue()
+
+    @DefaultConnection
+    def publish(self, push_message, connection=None):
+        """
+        Sends the push message without logging it.
+        """
+        json_string = payload_cache.get_topic_message(
+            application_cache.platforms(self.application_id).values(),
+            push_message
+        )
         return connection.publish(
             message=json_string,
             topic=self.arn,
             message_structure="json"
         )
 
+    async def asend(self, push_message, connection=None):
+        """
+        Awaitable version of send().
+        """
+        return await run_sync(self.send, push_message, connection=connection)
+
 
 class PushMessage(models.Model):
     MESSAGE_TYPE_DEFAULT = 0
     MESSAGE_TYPE_TOPIC = 1
+    STATUS_LOGGED = 0
+    STATUS_QUEUED = 1
+    STATUS_SENT = 2
+    STATUS_FAILED = 3
+    STATUS_CHOICES = (
+        (STATUS_LOGGED, 'logged'),
+        (STATUS_QUEUED, 'queued'),
+        (STATUS_SENT, 'sent'),
+        (STATUS_FAILED, 'failed'),
+    )
     sound = models.TextField(blank=True, null=True)
     message = models.TextField(default='', null=True)
     has_new_content = models.BooleanField(default=False)
     context_id = models.TextField(default='none', null=True)
     context = models.TextField(default='default', null=True)
     badge_count = models.SmallIntegerField(default=0)
-    extra_payload = models.TextField(blank=True, null=True)
+    extra_payload = JSONTextField(blank=True, null=True)
     receiver_arn = models.TextField(blank=True, null=True)
     message_type = models.PositiveSmallIntegerField(default=0)
+    status = models.PositiveSmallIntegerField(
+        choices=STATUS_CHOICES,
+        default=STATUS_LOGGED
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    collapse_key = models.CharField(max_length=255, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'],
+                         name='scarface_pushmessage_outbox'),
+        ]
 
     def as_dict(self):
         d = {
@@ -604,6 +1028,29 @@ class PushMessage(models.Model):
             d.update(self.extra_payload)
         return d
 
+    def enqueue(self):
+        """
+        Saves the message to the outbox. Sign it with the receiver first.
+        """
+        self.status = self.STATUS_QUEUED
+        self.attempts = 0
+        self.next_attempt = timezone.now()
+        self.last_error = None
+        self.save()
+
+    def clone(self, **kwargs):
+        """
+        Returns an unsaved copy of this message, created now. The keyword
+        arguments override the copied field values.
+        """
+        values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if not field.primary_key and field.attname != 'created'
+        }
+        values.update(kwargs)
+        return PushMessage(**values)
+
 
 class Subscription(SNSCRUDMixin, models.Model):
     topic = models.ForeignKey(
@@ -619,9 +1066,12 @@ class Subscription(SNSCRUDMixin, models.Model):
     arn = models.CharField(
         max_length=255,
         null=True,
-        blank=True
+        blank=True,
+        db_index=True
     )
 
+    objects = ArnQuerySet.as_manager()
+
     class Meta:
         unique_together = (('topic', 'device'))
 
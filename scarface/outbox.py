@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous delivery of push messages. Device.enqueue and Topic.enqueue
+store the message with the status queued, the scarface_worker command
+claims and publishes them.
+
+A claimed message keeps the status queued but its next attempt is moved
+SCARFACE_OUTBOX_LEASE seconds into the future. If a worker dies while
+sending, the message is picked up again once the lease has expired.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from scarface.application_cache import application_cache
+from scarface.bulk import run_concurrently
+from scarface.exceptions import BaseScarfaceException, \
+    NotRegisteredException, CircuitOpenException
+from scarface.utils import outbox_max_attempts, outbox_retry_delay, \
+    outbox_lease
+
+__author__ = 'dreipol GmbH'
+
+logger = logging.getLogger('django_scarface')
+
+
+def claim(batch_size):
+    """
+    Locks and leases up to batch_size due messages. Rows locked by other
+    workers are skipped.
+    :return: list of PushMessage
+    """
+    from scarface.models import PushMessage
+
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=outbox_lease())
+    with transaction.atomic():
+        messages = list(
+            PushMessage.objects.select_for_update(skip_locked=True).filter(
+                status=PushMessage.STATUS_QUEUED,
+                next_attempt__lte=now
+            ).order_by('next_attempt')[:batch_size]
+        )
+        PushMessage.objects.filter(
+            pk__in=[message.pk for message in messages]
+        ).update(next_attempt=lease_until, attempts=F('attempts') + 1)
+    for message in messages:
+        message.next_attempt = lease_until
+        message.attempts += 1
+    return messages
+
+
+def get_receivers(messages):
+    """
+    Loads the devices and topics the messages are addressed to, including
+    everything needed to format the payload.
+    :return: dict of receiver arn to Device or Topic
+    """
+    from scarface.models import Device, Topic, PushMessage
+
+    device_arns = set()
+    topic_arns = set()
+    for message in messages:
+        if message.message_type == PushMessage.MESSAGE_TYPE_TOPIC:
+            topic_arns.add(message.receiver_arn)
+        else:
+            device_arns.add(message.receiver_arn)
+
+    receivers = dict()
+    for device in Device.objects.by_arns(device_arns).select_related(
+            'platform'):
+        receivers[device.arn] = device
+    for topic in Topic.objects.by_arns(topic_arns):
+        # Loads the platforms of the application before the worker threads
+        # format the payload.
+        application_cache.platforms(topic.application_id)
+        receivers[topic.arn] = topic
+    return receivers
+
+
+def deliver(messages, connection=None, max_workers=None):
+    """
+    Publishes claimed messages concurrently and stores their outcome.
+    Failed messages are retried with an exponential delay until
+    SCARFACE_OUTBOX_MAX_ATTEMPTS is reached. Scarface errors are permanent,
+    except for an open circuit breaker.
+    :type connection: SNSConnection
+    :param connection: the connection which should be used. If the argument
+    isn't set every publish uses a pooled default connection.
+    :return: number of sent messages
+    """
+    from scarface.models import PushMessage
+
+    receivers = get_receivers(messages)
+
+    def publish(message, connection):
+        receiver = receivers.get(message.receiver_arn)
+        if receiver is None:
+            raise NotRegisteredException(
+                'No receiver with arn {0}'.format(message.receiver_arn)
+            )
+        return receiver.publish(message, connection)
+
+    sent = 0
+    now = timezone.now()
+    for message, response, error in run_concurrently(
+            publish, messages, connection, len(messages) or 1, max_workers):
+        if error is None:
+            sent += 1
+            message.status = PushMessage.STATUS_SENT
+            message.next_attempt = None
+            message.last_error = None
+            continue
+
+        logger.warning(u'Could not send push message {0}: {1}'.format(
+            message.pk, error
+        ))
+        message.last_error = str(error)
+        permanent = isinstance(error, BaseScarfaceException) and \
+            not isinstance(error, CircuitOpenException)
+        if permanent or message.attempts >= outbox_max_attempts():
+            message.status = PushMessage.STATUS_FAILED
+            message.next_attempt = None
+        else:
+            delay = outbox_retry_delay() * 2 ** (message.attempts - 1)
+            message.next_attempt = now + timedelta(seconds=delay)
+
+    PushMessage.objects.bulk_update(
+        messages, ['status', 'next_attempt', 'last_error']
+    )
+    return sent
+
+
+def process(batch_size, connection=None, max_workers=None):
+    """
+    Claims and delivers one batch.
+    :return: number of claimed messages
+    """
+    messages = claim(batch_size)
+    if messages:
+        deliver(messages, connection, max_workers)
+    return len(messages)
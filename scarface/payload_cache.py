@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+LRU cache of formatted payloads. Sending the same message to many devices
+or topics formats and encodes it once per platform type, respectively once
+per set of platforms for topics. The key is a digest of the message content
+and the strategy, so a message which is modified after sending gets a new
+entry.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from scarface.serialization import dumps
+from scarface.settings import SCARFACE_DEFAULT_PAYLOAD_CACHE_SIZE
+
+__author__ = 'dreipol GmbH'
+
+MESSAGE_FIELDS = ('message', 'sound', 'has_new_content', 'context',
+                  'context_id', 'badge_count', 'extra_payload',
+                  'collapse_key')
+
+
+def payload_cache_size():
+    return getattr(
+        settings,
+        'SCARFACE_PAYLOAD_CACHE_SIZE',
+        SCARFACE_DEFAULT_PAYLOAD_CACHE_SIZE
+    )
+
+
+def message_digest(push_message):
+    """
+    Returns a digest of the fields of a PushMessage which end up in the
+    payload. It is the same in every process.
+    :rtype: str
+    """
+    content = json.dumps(
+        [getattr(push_message, field) for field in MESSAGE_FIELDS],
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+
+class PayloadCache(object):
+    """
+    Holds up to SCARFACE_PAYLOAD_CACHE_SIZE formatted payloads. hits and
+    misses count the lookups since the last clear().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._payloads = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def _lookup(self, key):
+        with self._lock:
+            cached = self._payloads.get(key)
+            if cached is not None:
+                self.hits += 1
+                self._payloads.move_to_end(key)
+            else:
+                self.misses += 1
+            return cached
+
+    def _store(self, key, cached):
+        size = payload_cache_size()
+        if size:
+            with self._lock:
+                self._payloads[key] = cached
+                while len(self._payloads) > size:
+                    self._payloads.popitem(last=False)
+        return cached
+
+    def get(self, platform, push_message):
+        """
+        Returns the payload of a message for a platform, formatted by
+        Platform.format_payload, and the SNS message which sends it to an
+        endpoint. Don't modify the returned dict.
+        :return: (dict, str)
+        """
+        return self._get(platform, push_message, message_digest(push_message))
+
+    def _get(self, platform, push_message, digest):
+        key = (platform.strategy.id, platform.platform, digest)
+        cached = self._lookup(key)
+        if cached is None:
+            # The strategy may need the digest too, e.g. as collapse key
+            payload = platform.format_payload(push_message, digest=digest)
+            cached = self._store(key, (payload, dumps(payload)))
+        return cached
+
+    def get_topic_message(self, platforms, push_message):
+        """
+        Returns the SNS message which sends a message to a topic whose
+        application has the given platforms.
+        :rtype: str
+        """
+        digest = message_digest(push_message)
+        key = (frozenset((platform.strategy.id, platform.platform)
+                         for platform in platforms), digest)
+        cached = self._lookup(key)
+        if cached is None:
+            payload = dict()
+            for platform in platforms:
+                payload.update(self._get(platform, push_message, digest)[0])
+            payload["default"] = push_message.message
+            cached = self._store(key, dumps(payload))
+        return cached
+
+    def clear(self):
+        with self._lock:
+            self._payloads.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+payload_cache = PayloadCache()
+
+
+@receiver(setting_changed)
+def reset_payload_cache(setting, **kwargs):
+    if setting in ('SCARFACE_PAYLOAD_CACHE_SIZE',
+                   'SCARFACE_MESSAGE_TRIM_LENGTH',
+                   'SCARFACE_PLATFORM_STRATEGIES',
+                   'SCARFACE_JSON_BACKEND'):
+        payload_cache.clear()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled SNS messages. A strategy formats and encodes a push message
+once with placeholders for the values which change per recipient, e.g. the
+badge count. Rendering the template for a recipient only encodes these
+values and joins them with the constant parts.
+"""
+import copy
+import re
+
+from scarface.serialization import dumps
+
+__author__ = 'dreipol GmbH'
+
+''' Field of the PushMessage by slot name'''
+SLOT_FIELDS = {
+    'badge': 'badge_count',
+}
+
+
+def slot_sentinel(name):
+    """
+    Returns the value which marks a slot in the payload before encoding.
+    """
+    return u'\x00scarface:{0}\x00'.format(name)
+
+
+def encode_value(value):
+    """
+    Encodes a value like it appears in the SNS message, i.e. as JSON within
+    the JSON string of the platform payload.
+    """
+    return dumps(dumps(value))[1:-1]
+
+
+class PayloadTemplate(object):
+    """
+    SNS message split at its slots.
+    """
+
+    def __init__(self, message, defaults=None):
+        """
+        :param message: the encoded SNS message with the slot sentinels
+        :param defaults: dict of slot name to the value used if render()
+        isn't given one
+        """
+        self.defaults = dict(defaults or {})
+        if not self.defaults:
+            self.segments = [message]
+            self.slots = []
+            return
+        markers = dict(
+            (encode_value(slot_sentinel(name)), name)
+            for name in self.defaults
+        )
+        parts = re.split(
+            u'({0})'.format(u'|'.join(re.escape(m) for m in markers)),
+            message
+        )
+        self.segments = parts[::2]
+        self.slots = [markers[marker] for marker in parts[1::2]]
+
+    def render(self, **values):
+        """
+        :return: the SNS message with the given slot values
+        """
+        if not self.slots:
+            return self.segments[0]
+        parts = [self.segments[0]]
+        for name, segment in zip(self.slots, self.segments[1:]):
+            value = values[name] if name in values else self.defaults[name]
+            parts.append(encode_value(value))
+            parts.append(segment)
+        return u''.join(parts)
+
+
+class FormattingTemplate(object):
+    """
+    Fallback for strategies which can't compile the slots. Renders the SNS
+    message by formatting a copy of the push message with the slot values.
+    """
+
+    def __init__(self, strategy, message):
+        self.strategy = strategy
+        self.message = message
+
+    def render(self, **values):
+        """
+        :return: the SNS message with the given slot values
+        """
+        message = self.message
+        if values:
+            message = copy.copy(message)
+            for name, value in values.items():
+                setattr(message, SLOT_FIELDS[name], value)
+        return dumps(self.strategy.format_payload(message))
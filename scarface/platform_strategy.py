@@ -1,16 +1,37 @@
 # -*- coding: utf-8 -*-
-import json
 from abc import ABCMeta
 from copy import deepcopy
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.module_loading import import_string
 from six import with_metaclass
 
+from scarface.exceptions import PayloadTooLarge
+from scarface.payload_cache import message_digest
+from scarface.payload_template import PayloadTemplate, FormattingTemplate, \
+    slot_sentinel
+from scarface.serialization import dumps
 from scarface.settings import SCARFACE_DEFAULT_PLATFORM_STRATEGIES, SCARFACE_DEFAULT_MESSAGE_TRIM_LENGTH
 
 
+_strategies = None
+
+
 def get_strategies():
+    """
+    Returns the registered strategy classes by their id. The strategies are
+    imported once and cached until SCARFACE_PLATFORM_STRATEGIES changes.
+    Don't modify the returned dict.
+    """
+    global _strategies
+    if _strategies is None:
+        _strategies = load_strategies()
+    return _strategies
+
+
+def load_strategies():
     strategy_modules = deepcopy(SCARFACE_DEFAULT_PLATFORM_STRATEGIES)
     if hasattr(settings, 'SCARFACE_PLATFORM_STRATEGIES'):
         strategy_modules += settings.SCARFACE_PLATFORM_STRATEGIES
@@ -22,6 +43,13 @@ def get_strategies():
     return strategies
 
 
+@receiver(setting_changed)
+def reset_strategies(setting, **kwargs):
+    global _strategies
+    if setting == 'SCARFACE_PLATFORM_STRATEGIES':
+        _strategies = None
+
+
 def get_strategy_choices():
     strategies = get_strategies()
     choices = {}
@@ -30,6 +58,21 @@ def get_strategy_choices():
     return choices
 
 
+def truncate_utf8(text, max_bytes, suffix=u'...'):
+    """
+    Shortens text so that its UTF-8 encoding including the suffix has at
+    most max_bytes. The text is cut at a character boundary.
+    """
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    suffix_bytes = len(suffix.encode('utf-8'))
+    if max_bytes < suffix_bytes:
+        return u''
+    return encoded[:max_bytes - suffix_bytes].decode(
+        'utf-8', 'ignore') + suffix
+
+
 class PlatformStrategy(with_metaclass(ABCMeta)):
     def __init__(self, platform_application):
         super(PlatformStrategy, self).__init__()
@@ -41,8 +84,101 @@ class PlatformStrategy(with_metaclass(ABCMeta)):
     ''' Verbose name of that strategie's service'''
     service_name = ''
 
+    ''' Maximum size of the encoded payload in bytes, None for no limit'''
+    max_payload_bytes = None
+
+    ''' Keys of the message text within the payload, it is shortened if
+    the payload is too large'''
+    message_path = None
+
+    ''' Keys of the values within the payload which may differ per
+    recipient, by slot name'''
+    slot_paths = {}
+
+    ''' Method returning the payload of a PushMessage as dict. Needed to
+    compile templates with slots, without it compile() falls back to
+    formatting the message per recipient'''
+    build_payload = None
+
+    ''' True if format_payload takes the message_digest() of the message
+    as digest argument, so it isn't computed twice'''
+    uses_digest = False
+
     def format_payload(self, data):
-        return {self.platform.platform: json.dumps(data)}
+        return {self.platform.platform: self.encode_payload(data)}
+
+    def compile(self, message, slots=()):
+        """
+        Formats and encodes the message once. The returned template renders
+        the SNS message for this platform with other values for the given
+        slots, see slot_paths.
+        :rtype: PayloadTemplate or FormattingTemplate
+        """
+        if not slots:
+            return PayloadTemplate(dumps(self.format_payload(message)))
+        if self.build_payload is None or \
+                any(name not in self.slot_paths for name in slots):
+            return FormattingTemplate(self, message)
+        data = self.build_payload(message)
+        defaults = dict()
+        for name in slots:
+            container = data
+            for key in self.slot_paths[name][:-1]:
+                container = container.setdefault(key, {})
+            key = self.slot_paths[name][-1]
+            defaults[name] = container.get(key)
+            container[key] = slot_sentinel(name)
+        return PayloadTemplate(
+            dumps(PlatformStrategy.format_payload(self, data)), defaults
+        )
+
+    def encode_payload(self, data):
+        """
+        Serializes the payload. If it exceeds max_payload_bytes the message
+        is shortened as little as possible, found by a binary search over
+        its length.
+        :raise PayloadTooLarge: if the payload doesn't fit even without
+        the message.
+        """
+        encoded = dumps(data)
+        limit = self.max_payload_bytes
+        if limit is None or len(encoded.encode('utf-8')) <= limit:
+            return encoded
+
+        container = data
+        for key in (self.message_path or ())[:-1]:
+            container = container.get(key) \
+                if isinstance(container, dict) else None
+        key = self.message_path[-1] if self.message_path else None
+        message = container.get(key) if isinstance(container, dict) else None
+        if not isinstance(message, str):
+            raise PayloadTooLarge(
+                'Payload of {0} bytes exceeds {1} bytes'.format(
+                    len(encoded.encode('utf-8')), limit)
+            )
+
+        def fits(length):
+            container[key] = truncate_utf8(message, length)
+            candidate = dumps(data)
+            return candidate if len(candidate.encode('utf-8')) <= limit \
+                else None
+
+        # Search the largest message size in bytes which fits
+        low, high = 0, min(len(message.encode('utf-8')) - 1, limit)
+        best = fits(low)
+        if best is None:
+            raise PayloadTooLarge(
+                'Payload exceeds {0} bytes without the message'.format(limit)
+            )
+        while low < high:
+            middle = (low + high + 1) // 2
+            candidate = fits(middle)
+            if candidate is None:
+                high = middle - 1
+            else:
+                low, best = middle, candidate
+        container[key] = truncate_utf8(message, low)
+        return best
 
     def format_push(self, badgeCount, context, context_id, has_new_content, message,
             sound):
@@ -73,21 +209,22 @@ class PlatformStrategy(with_metaclass(ABCMeta)):
         return payload
 
     def trim_message(self, message):
-        import sys
+        """
+        Shortens the message to SCARFACE_MESSAGE_TRIM_LENGTH bytes of UTF-8.
+        """
         trim_length = SCARFACE_DEFAULT_MESSAGE_TRIM_LENGTH
         if hasattr(settings, 'SCARFACE_MESSAGE_TRIM_LENGTH'):
             trim_length = settings.SCARFACE_MESSAGE_TRIM_LENGTH
-
-        if sys.getsizeof(message) > trim_length:
-            while sys.getsizeof(message) > trim_length:
-                message = message[:-3]
-            message += '...'
-        return message
+        return truncate_utf8(message, trim_length)
 
 
 class APNPlatformStrategy(PlatformStrategy):
     id = 'APNS'
     service_name = 'Apple Push Notification Service (APNS)'
+    max_payload_bytes = 4096
+    message_path = ('aps', 'alert')
+
+    slot_paths = {'badge': ('aps', 'badge')}
 
     def format_payload(self, message):
         """
@@ -95,7 +232,12 @@ class APNPlatformStrategy(PlatformStrategy):
         :param message:
         :return:
         """
+        return super(
+            APNPlatformStrategy,
+            self
+        ).format_payload(self.build_payload(message))
 
+    def build_payload(self, message):
         payload = self.format_push(
             message.badge_count,
             message.context,
@@ -111,16 +253,16 @@ class APNPlatformStrategy(PlatformStrategy):
                 # any alert props
                 payload['aps'].update(extra.pop('aps'))
             payload.update(extra)
-
-        return super(
-            APNPlatformStrategy,
-            self
-        ).format_payload(payload)
+        return payload
 
 
 class APNSSandboxPlatformStrategy(PlatformStrategy):
     id = 'APNS_SANDBOX'
     service_name = 'Apple Push Notification Service Sandbox (APNS_SANDBOX)'
+    max_payload_bytes = 4096
+    message_path = ('aps', 'alert')
+
+    slot_paths = {'badge': ('aps', 'badge')}
 
     def format_payload(self, message):
         """
@@ -128,7 +270,12 @@ class APNSSandboxPlatformStrategy(PlatformStrategy):
         :param message:
         :return:
         """
+        return super(
+            APNSSandboxPlatformStrategy,
+            self
+        ).format_payload(self.build_payload(message))
 
+    def build_payload(self, message):
         payload = self.format_push(
             message.badge_count,
             message.context,
@@ -139,26 +286,37 @@ class APNSSandboxPlatformStrategy(PlatformStrategy):
 
         if message.extra_payload:
             payload.update(message.extra_payload)
-
-        return super(
-            APNSSandboxPlatformStrategy,
-            self
-        ).format_payload(payload)
+        return payload
 
 
 class GCMPlatformStrategy(PlatformStrategy):
     id = 'GCM'
     service_name = 'Google Cloud Messaging (GCM)'
+    max_payload_bytes = 4096
+    message_path = ('data', 'message')
 
-    def format_payload(self, message):
+    slot_paths = {'badge': ('data', 'badge_count')}
+
+    uses_digest = True
+
+    def format_payload(self, message, digest=None):
         """
         :type data: PushMessage
         :param data:
+        :param digest: message_digest() of the message if it is known
         :return:
         """
-        data = message.as_dict()
-        h = hash(frozenset(data.items()))
         return super(
             GCMPlatformStrategy,
             self
-        ).format_payload({"collapse_key": h, "data": data})
+        ).format_payload(self.build_payload(message, digest))
+
+    def build_payload(self, message, digest=None):
+        """
+        Messages with the same content get the same collapse key in every
+        process, unless the message sets its own collapse_key.
+        """
+        data = message.as_dict()
+        collapse_key = message.collapse_key or digest or \
+            message_digest(message)
+        return {"collapse_key": collapse_key, "data": data}
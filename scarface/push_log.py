@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Logging of sent push messages. With SCARFACE_LOGGING_MODE = 'buffered' the
+messages are collected and written with bulk_create once the buffer is
+full, the flush interval has passed, the current transaction commits or
+the request finishes. The buffer is never written within a transaction,
+it is shared by all threads and a rollback would drop their messages.
+Messages older than SCARFACE_LOG_RETENTION_DAYS are removed with purge().
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, transaction
+from django.db.models import Max, Min
+from django.dispatch import receiver
+from django.utils import timezone
+
+from scarface.settings import SCARFACE_DEFAULT_LOGGING_MODE, \
+    SCARFACE_DEFAULT_LOGGING_BUFFER_SIZE, \
+    SCARFACE_DEFAULT_LOGGING_FLUSH_INTERVAL, \
+    SCARFACE_DEFAULT_LOGGING_MAX_BACKLOG, \
+    SCARFACE_DEFAULT_LOG_RETENTION_DAYS
+
+__author__ = 'dreipol GmbH'
+
+logger = logging.getLogger('django_scarface')
+
+LOGGING_MODE_SYNC = 'sync'
+LOGGING_MODE_BUFFERED = 'buffered'
+
+
+def logging_mode():
+    return getattr(
+        settings,
+        'SCARFACE_LOGGING_MODE',
+        SCARFACE_DEFAULT_LOGGING_MODE
+    )
+
+
+def logging_buffer_size():
+    return getattr(
+        settings,
+        'SCARFACE_LOGGING_BUFFER_SIZE',
+        SCARFACE_DEFAULT_LOGGING_BUFFER_SIZE
+    )
+
+
+def logging_flush_interval():
+    return getattr(
+        settings,
+        'SCARFACE_LOGGING_FLUSH_INTERVAL',
+        SCARFACE_DEFAULT_LOGGING_FLUSH_INTERVAL
+    )
+
+
+def logging_max_backlog():
+    return getattr(
+        settings,
+        'SCARFACE_LOGGING_MAX_BACKLOG',
+        SCARFACE_DEFAULT_LOGGING_MAX_BACKLOG
+    )
+
+
+def log_retention_days():
+    return getattr(
+        settings,
+        'SCARFACE_LOG_RETENTION_DAYS',
+        SCARFACE_DEFAULT_LOG_RETENTION_DAYS
+    )
+
+
+def on_commit_once(func, using=None):
+    """
+    Registers func to run after the current transaction commits unless it
+    is registered already. Outside of a transaction nothing happens.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return
+    for callback in connection.run_on_commit:
+        if callback[1] == func:
+            return
+    transaction.on_commit(func, using)
+
+
+class PushLogBuffer(object):
+    """
+    Collects copies of the logged messages. At most
+    SCARFACE_LOGGING_BUFFER_SIZE messages are kept before they are written,
+    a background timer writes the rest after SCARFACE_LOGGING_FLUSH_INTERVAL
+    seconds. If writing fails the messages are kept and written with the
+    next flush after the interval, up to SCARFACE_LOGGING_MAX_BACKLOG
+    messages. Beyond that the oldest ones are dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = list()
+        self._last_flush = time.monotonic()
+        self._retry_at = 0
+        self._timer = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, push_message):
+        # The caller may reuse the message for the next receiver, a copy
+        # keeps the receiver it was logged for.
+        with self._lock:
+            self._messages.append(push_message.clone())
+            dropped = len(self._messages) - logging_max_backlog()
+            if dropped > 0:
+                del self._messages[:dropped]
+            now = time.monotonic()
+            retry = now >= self._retry_at
+            flush = retry and (
+                len(self._messages) >= logging_buffer_size() or
+                now - self._last_flush >= logging_flush_interval()
+            )
+            if not flush:
+                self._schedule()
+        if dropped > 0:
+            logger.warning(
+                'Push log backlog is full, dropped {0} messages'.format(
+                    dropped)
+            )
+        if flush:
+            self.flush()
+        elif retry:
+            on_commit_once(self.flush)
+
+    def _schedule(self):
+        # Called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(logging_flush_interval(),
+                                          self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_in_background(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            # The timer thread ends here, don't leave its connection open
+            connections.close_all()
+
+    def flush(self):
+        """
+        Writes the buffered messages. Within a transaction they are written
+        after the commit.
+        """
+        from scarface.models import PushMessage
+
+        using = PushMessage.objects.db
+        if transaction.get_connection(using).in_atomic_block:
+            on_commit_once(self.flush, using)
+            return
+        with self._lock:
+            messages, self._messages = self._messages, list()
+            self._last_flush = time.monotonic()
+        if not messages:
+            return
+        try:
+            PushMessage.objects.bulk_create(messages)
+        except Exception:
+            logger.exception(
+                'Could not write {0} push messages'.format(len(messages))
+            )
+            with self._lock:
+                self._messages[:0] = messages
+                dropped = len(self._messages) - logging_max_backlog()
+                if dropped > 0:
+                    del self._messages[:dropped]
+                self._retry_at = time.monotonic() + logging_flush_interval()
+                self._schedule()
+            if dropped > 0:
+                logger.warning(
+                    'Push log backlog is full, dropped {0} messages'.format(
+                        dropped)
+                )
+        else:
+            self._retry_at = 0
+
+
+buffer = PushLogBuffer()
+atexit.register(buffer.flush)
+
+
+@receiver(request_finished)
+def flush_buffer(**kwargs):
+    if len(buffer) and time.monotonic() >= buffer._retry_at:
+        buffer.flush()
+
+
+def log(push_message):
+    """
+    Stores the push message, either right away or through the buffer.
+    """
+    if logging_mode() == LOGGING_MODE_BUFFERED:
+        buffer.add(push_message)
+    else:
+        push_message.save()
+
+
+def purge(days=None, chunk_size=1000):
+    """
+    Deletes the push messages created more than days ago. Queued messages
+    are kept. The rows are deleted with one statement per primary key range
+    of chunk_size, so no row is loaded and every lock is short lived.
+    :param days: defaults to SCARFACE_LOG_RETENTION_DAYS
+    :return: number of deleted messages
+    """
+    from scarface.models import PushMessage
+
+    if days is None:
+        days = log_retention_days()
+    cutoff = timezone.now() - timedelta(days=days)
+    expired = PushMessage.objects.filter(created__lt=cutoff).exclude(
+        status=PushMessage.STATUS_QUEUED
+    )
+    bounds = expired.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return 0
+
+    deleted = 0
+    for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+        count, _ = expired.filter(
+            pk__gte=start, pk__lt=start + chunk_size
+        ).delete()
+        deleted += count
+    return deleted
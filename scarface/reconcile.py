@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the devices and subscriptions stored in the database with the
+endpoints and subscriptions SNS holds. SNS is listed page by page and the
+pages are matched against the database in chunks. Only the remote arns are
+kept in memory to find the local arns SNS doesn't know anymore.
+
+Devices and subscriptions may be registered while SNS is listed, so nothing
+is removed based on the listing alone: orphans are checked against the
+database again once the listing is done and stale rows are looked up in SNS
+again before their arn is cleared.
+"""
+import logging
+
+from django.db.models import Max
+
+from scarface.bulk import run_concurrently
+from scarface.utils import chunked, chunked_by_pk, bulk_chunk_size
+
+__author__ = 'dreipol GmbH'
+
+logger = logging.getLogger('django_scarface')
+
+
+class ReconciliationReport(object):
+    """
+    Differences found for a platform or a topic.
+
+    remote: number of endpoints or subscriptions in SNS
+    local: number of registered devices or subscriptions in the database
+    orphaned: in SNS without a local row
+    stale: local rows whose arn SNS doesn't know
+    linked: SNS subscriptions of known devices without a matching local row
+    disabled: endpoints SNS has disabled
+    fixed: number of applied fixes
+    """
+    SAMPLE_SIZE = 10
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.remote = 0
+        self.local = 0
+        self.orphaned = 0
+        self.stale = 0
+        self.linked = 0
+        self.disabled = 0
+        self.fixed = 0
+        self.samples = dict()
+
+    def add(self, kind, arns):
+        setattr(self, kind, getattr(self, kind) + len(arns))
+        samples = self.samples.setdefault(kind, list())
+        samples.extend(arns[:self.SAMPLE_SIZE - len(samples)])
+
+    @property
+    def in_sync(self):
+        return not (self.orphaned or self.stale or self.linked)
+
+    def __str__(self):
+        return (
+            u'{0}: {1} remote, {2} local, {3} orphaned, {4} stale, '
+            u'{5} linked, {6} disabled, {7} fixed'.format(
+                self.resource, self.remote, self.local, self.orphaned,
+                self.stale, self.linked, self.disabled, self.fixed
+            )
+        )
+
+
+def reconcile_platform(platform, apply=False, delete_orphans=False,
+                       connection=None, chunk_size=None, max_workers=None):
+    """
+    Compares the endpoints of a platform with its devices.
+
+    :param apply: clear the arn of devices SNS doesn't know anymore. Each
+    stale endpoint is looked up first, it may have been created after the
+    listing.
+    :param delete_orphans: delete the endpoints without a local device.
+    Endpoints whose arn or token a device of the platform got during the
+    listing are kept.
+    :type connection: SNSConnection
+    :param connection: the connection which should be used. If the argument
+    isn't set pooled default connections are used.
+    :rtype: ReconciliationReport
+    """
+    from scarface.models import Device
+
+    chunk_size = chunk_size or bulk_chunk_size()
+    report = ReconciliationReport(platform)
+    remote_arns = set()
+    orphans = dict()
+    # Devices created while SNS is listed may be missing in the listing
+    registered = platform.devices.exclude(arn__isnull=True).exclude(arn='')
+    last_pk = registered.aggregate(last=Max('pk'))['last'] or 0
+
+    for endpoints in platform.iter_endpoint_pages(connection):
+        for chunk in chunked(endpoints, chunk_size):
+            arns = [endpoint['EndpointArn'] for endpoint in chunk]
+            remote_arns.update(arns)
+            report.remote += len(arns)
+            report.add('disabled', [
+                endpoint['EndpointArn'] for endpoint in chunk
+                if endpoint.get('Attributes', {}).get('Enabled') == 'false'
+            ])
+            known = set(
+                Device.objects.by_arns(arns).values_list('arn', flat=True)
+            )
+            orphaned = [arn for arn in arns if arn not in known]
+            report.add('orphaned', orphaned)
+            if delete_orphans:
+                orphans.update(
+                    (endpoint['EndpointArn'],
+                     endpoint.get('Attributes', {}).get('Token'))
+                    for endpoint in chunk
+                    if endpoint['EndpointArn'] not in known
+                )
+
+    for chunk in chunked(orphans.items(), chunk_size):
+        orphaned = _orphaned_endpoints(platform, dict(chunk))
+        if orphaned:
+            report.fixed += _run(
+                lambda arn, connection: connection.delete_endpoint(arn),
+                orphaned, connection, chunk_size, max_workers
+            )
+
+    for chunk in chunked_by_pk(registered.filter(pk__lte=last_pk), chunk_size,
+                               'arn'):
+        report.local += len(chunk)
+        stale = [(pk, arn) for pk, arn in chunk if arn not in remote_arns]
+        report.add('stale', [arn for pk, arn in stale])
+        if apply and stale:
+            missing = _missing_endpoints(stale, connection, chunk_size,
+                                         max_workers)
+            report.fixed += Device.objects.filter(
+                pk__in=[pk for pk, arn in missing],
+                arn__in=[arn for pk, arn in missing]
+            ).update(arn=None)
+
+    return report
+
+
+def reconcile_topic(topic, apply=False, delete_orphans=False,
+                    connection=None, chunk_size=None, max_workers=None):
+    """
+    Compares the subscriptions of a topic in SNS with the local ones.
+
+    :param apply: create or update the local subscriptions of known devices
+    and clear the arn of subscriptions SNS doesn't know anymore. The topic is
+    listed once more before, subscriptions stored during the first listing
+    may be missing in it.
+    :param delete_orphans: unsubscribe endpoints without a local device.
+    :type connection: SNSConnection
+    :param connection: the connection which should be used. If the argument
+    isn't set pooled default connections are used.
+    :rtype: ReconciliationReport
+    """
+    from scarface.models import Device, Subscription
+
+    chunk_size = chunk_size or bulk_chunk_size()
+    report = ReconciliationReport(topic)
+    remote_arns = set()
+    # Subscriptions created while SNS is listed may be missing in the listing
+    registered = topic.subscription_set.exclude(arn__isnull=True).exclude(
+        arn='')
+    last_pk = registered.aggregate(last=Max('pk'))['last'] or 0
+
+    for chunk in chunked(topic.iter_subscriptions(connection), chunk_size):
+        endpoints = dict(
+            (subscription['SubscriptionArn'], subscription['Endpoint'])
+            for subscription in chunk
+            if subscription.get('Protocol', 'application') == 'application'
+        )
+        remote_arns.update(endpoints.keys())
+        report.remote += len(endpoints)
+
+        known = set(
+            Subscription.objects.by_arns(endpoints.keys()).filter(
+                topic=topic
+            ).values_list('arn', flat=True)
+        )
+        unknown = dict(
+            (arn, endpoint) for arn, endpoint in endpoints.items()
+            if arn not in known
+        )
+        devices = dict(
+            Device.objects.by_arns(unknown.values()).values_list('arn', 'pk')
+        )
+        linked = dict(
+            (devices[endpoint], arn) for arn, endpoint in unknown.items()
+            if endpoint in devices
+        )
+        orphaned = [
+            arn for arn, endpoint in unknown.items() if endpoint not in devices
+        ]
+        report.add('linked', list(linked.values()))
+        report.add('orphaned', orphaned)
+
+        if apply and linked:
+            report.fixed += _link_subscriptions(topic, linked)
+        if delete_orphans and orphaned:
+            report.fixed += _run(
+                lambda arn, connection: connection.unsubscribe(arn),
+                orphaned, connection, chunk_size, max_workers
+            )
+
+    stale = list()
+    for chunk in chunked_by_pk(registered.filter(pk__lte=last_pk), chunk_size,
+                               'arn'):
+        report.local += len(chunk)
+        stale.extend((pk, arn) for pk, arn in chunk if arn not in remote_arns)
+    report.add('stale', [arn for pk, arn in stale])
+
+    if apply and stale:
+        stale_arns = set(arn for pk, arn in stale)
+        listed = set(
+            subscription['SubscriptionArn']
+            for subscription in topic.iter_subscriptions(connection)
+            if subscription['SubscriptionArn'] in stale_arns
+        )
+        stale = [(pk, arn) for pk, arn in stale if arn not in listed]
+        for chunk in chunked(stale, chunk_size):
+            # Only rows whose arn wasn't changed since they were read
+            report.fixed += Subscription.objects.filter(
+                pk__in=[pk for pk, arn in chunk],
+                arn__in=[arn for pk, arn in chunk]
+            ).update(arn=None)
+
+    return report
+
+
+def _link_subscriptions(topic, linked):
+    """
+    Stores the subscription arns of devices by their primary key. Existing
+    subscriptions are updated, missing ones created.
+    """
+    from scarface.models import Subscription
+
+    existing = list(
+        Subscription.objects.filter(topic=topic, device_id__in=linked.keys())
+    )
+    for subscription in existing:
+        subscription.arn = linked.pop(subscription.device_id)
+    Subscription.objects.bulk_update(existing, ['arn'])
+    Subscription.objects.bulk_create([
+        Subscription(topic=topic, device_id=device_id, arn=arn)
+        for device_id, arn in linked.items()
+    ])
+    return len(existing) + len(linked)
+
+
+def _orphaned_endpoints(platform, orphans):
+    """
+    Returns the arns of the orphans which still don't belong to a device.
+    :param orphans: dict of endpoint arns to their tokens
+    """
+    from scarface.models import Device
+
+    known = set(
+        Device.objects.by_arns(orphans.keys()).values_list('arn', flat=True)
+    )
+    tokens = set(
+        platform.devices.filter(
+            push_token__in=[token for token in orphans.values() if token]
+        ).values_list('push_token', flat=True)
+    )
+    return [
+        arn for arn, token in orphans.items()
+        if arn not in known and token not in tokens
+    ]
+
+
+def _missing_endpoints(stale, connection, chunk_size, max_workers):
+    """
+    Returns the (pk, arn) tuples of the stale devices whose endpoint SNS
+    doesn't find.
+    """
+    missing = []
+    for item, result, error in run_concurrently(
+            lambda item, connection: connection.get_endpoint_attributes(
+                item[1]),
+            stale, connection, chunk_size, max_workers):
+        if getattr(error, 'error_code', None) == 'NotFound':
+            missing.append(item)
+        elif error is not None:
+            logger.warning(u'Could not look up {0}: {1}'.format(
+                item[1], error))
+    return missing
+
+
+def _run(func, arns, connection, chunk_size, max_workers):
+    fixed = 0
+    for arn, result, error in run_concurrently(
+            func, arns, connection, chunk_size, max_workers):
+        if error is None:
+            fixed += 1
+        else:
+            logger.warning(u'Could not remove {0}: {1}'.format(arn, error))
+    return fixed
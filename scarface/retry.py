@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Retry policy for SNS calls. Throttling, server and connection errors are
+retried with a capped exponential backoff and full jitter, so the retries
+of many concurrent senders spread out instead of hitting SNS at the same
+time.
+All other errors, e.g. invalid parameters or disabled endpoints, are
+raised right away.
+"""
+import random
+import socket
+from http.client import HTTPException
+
+from boto.exception import BotoServerError
+from django.conf import settings
+
+from scarface.settings import SCARFACE_DEFAULT_RETRY_MAX_ATTEMPTS, \
+    SCARFACE_DEFAULT_RETRY_BASE_DELAY, SCARFACE_DEFAULT_RETRY_MAX_DELAY
+
+__author__ = 'dreipol GmbH'
+
+RETRYABLE_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'Throttled',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'KMSThrottling',
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+])
+
+
+def retry_max_attempts():
+    return getattr(
+        settings,
+        'SCARFACE_RETRY_MAX_ATTEMPTS',
+        SCARFACE_DEFAULT_RETRY_MAX_ATTEMPTS
+    )
+
+
+def retry_base_delay():
+    return getattr(
+        settings,
+        'SCARFACE_RETRY_BASE_DELAY',
+        SCARFACE_DEFAULT_RETRY_BASE_DELAY
+    )
+
+
+def retry_max_delay():
+    return getattr(
+        settings,
+        'SCARFACE_RETRY_MAX_DELAY',
+        SCARFACE_DEFAULT_RETRY_MAX_DELAY
+    )
+
+
+def is_retryable(error):
+    """
+    Returns True if the call which raised error may succeed when it is
+    repeated.
+    """
+    if isinstance(error, (HTTPException, socket.error)):
+        return True
+    if not isinstance(error, BotoServerError):
+        return False
+    if error.error_code in RETRYABLE_ERROR_CODES:
+        return True
+    return error.status == 429 or error.status >= 500
+
+
+def backoff(attempt):
+    """
+    Returns the seconds to wait before the next attempt, a random value
+    between zero and the exponentially growing, capped delay.
+    :param attempt: number of failed attempts so far, starting with 1
+    """
+    delay = min(
+        retry_max_delay(),
+        retry_base_delay() * 2 ** (attempt - 1)
+    )
+    return random.uniform(0, delay)
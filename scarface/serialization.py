@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding of the payloads. SCARFACE_JSON_BACKEND selects the encoder:
+
+    'auto'   orjson if it is installed, the json module otherwise
+    'json'   the json module of the standard library
+    'orjson' orjson
+    or the dotted path to a function which takes an object and returns a
+    JSON string.
+
+The output is compact and not ASCII escaped.
+"""
+import json
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from scarface.settings import SCARFACE_DEFAULT_JSON_BACKEND
+
+__author__ = 'dreipol GmbH'
+
+JSON_BACKEND_AUTO = 'auto'
+JSON_BACKEND_JSON = 'json'
+JSON_BACKEND_ORJSON = 'orjson'
+
+_dumps = None
+
+
+def json_backend():
+    return getattr(
+        settings,
+        'SCARFACE_JSON_BACKEND',
+        SCARFACE_DEFAULT_JSON_BACKEND
+    )
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def json_dumps(obj):
+    # json.dumps creates a new encoder for every call with custom options
+    return _encoder.encode(obj)
+
+
+def orjson_dumps(obj):
+    import orjson
+
+    try:
+        return orjson.dumps(obj).decode('utf-8')
+    except TypeError:
+        # orjson is stricter, e.g. it rejects keys which aren't strings
+        return json_dumps(obj)
+
+
+def load_backend():
+    backend = json_backend()
+    if backend == JSON_BACKEND_AUTO:
+        try:
+            import orjson  # noqa
+        except ImportError:
+            return json_dumps
+        return orjson_dumps
+    if backend == JSON_BACKEND_JSON:
+        return json_dumps
+    if backend == JSON_BACKEND_ORJSON:
+        import orjson  # noqa
+        return orjson_dumps
+    return import_string(backend)
+
+
+def dumps(obj):
+    """
+    Serializes obj with the configured backend.
+    :rtype: str
+    """
+    global _dumps
+    if _dumps is None:
+        _dumps = load_backend()
+    return _dumps(obj)
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _dumps
+    if setting == 'SCARFACE_JSON_BACKEND':
+        _dumps = None
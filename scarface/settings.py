@@ -6,3 +6,53 @@ SCARFACE_DEFAULT_PLATFORM_STRATEGIES = [
 ]
 
 SCARFACE_DEFAULT_MESSAGE_TRIM_LENGTH = 140
+
+SCARFACE_DEFAULT_BULK_CHUNK_SIZE = 500
+
+SCARFACE_DEFAULT_BULK_MAX_WORKERS = 10
+
+SCARFACE_DEFAULT_CONNECTION_POOL_SIZE = 10
+
+SCARFACE_DEFAULT_ASYNC_MAX_CONCURRENCY = 50
+
+SCARFACE_DEFAULT_OUTBOX_MAX_ATTEMPTS = 5
+
+SCARFACE_DEFAULT_OUTBOX_RETRY_DELAY = 60
+
+SCARFACE_DEFAULT_OUTBOX_LEASE = 300
+
+SCARFACE_DEFAULT_LOGGING_MODE = 'sync'
+
+SCARFACE_DEFAULT_LOGGING_BUFFER_SIZE = 500
+
+SCARFACE_DEFAULT_LOGGING_FLUSH_INTERVAL = 5
+
+SCARFACE_DEFAULT_LOGGING_MAX_BACKLOG = 10000
+
+SCARFACE_DEFAULT_LOG_RETENTION_DAYS = 30
+
+SCARFACE_DEFAULT_RATE_LIMITS = {}
+
+SCARFACE_DEFAULT_RATE_LIMIT_BACKEND = 'local'
+
+SCARFACE_DEFAULT_RATE_LIMIT_CACHE = 'default'
+
+SCARFACE_DEFAULT_RATE_LIMIT_LEASE = 10
+
+SCARFACE_DEFAULT_RETRY_MAX_ATTEMPTS = 4
+
+SCARFACE_DEFAULT_RETRY_BASE_DELAY = 0.1
+
+SCARFACE_DEFAULT_RETRY_MAX_DELAY = 5
+
+SCARFACE_DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 5
+
+SCARFACE_DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 60
+
+SCARFACE_DEFAULT_DEREGISTER_ON_COMMIT = True
+
+SCARFACE_DEFAULT_APPLICATION_CACHE_TIMEOUT = 60
+
+SCARFACE_DEFAULT_JSON_BACKEND = 'auto'
+
+SCARFACE_DEFAULT_PAYLOAD_CACHE_SIZE = 1024
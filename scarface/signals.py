@@ -1,29 +1,107 @@
 # -*- coding: utf-8 -*-
 import logging
 
-from django.db.models.signals import  post_delete
+from django.db import transaction
+from django.db.models.signals import  post_delete, post_save
 from django.dispatch import receiver
 
+from scarface.application_cache import application_cache
+from scarface.bulk import run_concurrently
 from scarface.exceptions import SNSException
-from scarface.models import Device, Platform, Topic, Subscription
+from scarface.models import Application, Device, Platform, Topic, \
+    Subscription
+from scarface.utils import deregister_on_commit
 
 __author__ = 'janmeier'
 
 logger = logging.getLogger('django_scarface')
 
+
+class DeregistrationBatch(list):
+    """
+    Instances deleted within a transaction. Called after the commit, it
+    deregisters them concurrently. Devices and subscriptions go first, then
+    the platforms and topics they belonged to.
+    """
+
+    def __call__(self):
+        leaves = [i for i in self if isinstance(i, (Device, Subscription))]
+        others = [i for i in self if not isinstance(i, (Device, Subscription))]
+        for instances in (leaves, others):
+            for instance, success, error in run_concurrently(
+                    deregister, instances):
+                log_result(instance, success, error)
+
+
+def get_batch(using):
+    """
+    Returns the batch of the current transaction or savepoint. Rolling
+    back discards the batch together with its on_commit callback.
+    """
+    connection = transaction.get_connection(using)
+    savepoint_ids = set(connection.savepoint_ids)
+    for callback in connection.run_on_commit:
+        if callback[0] == savepoint_ids and \
+                isinstance(callback[1], DeregistrationBatch):
+            return callback[1]
+    batch = DeregistrationBatch()
+    transaction.on_commit(batch, using)
+    return batch
+
+
+def deregister(instance, connection):
+    return instance.deregister(connection=connection, save=False)
+
+
+def log_result(instance, success, error):
+    if error is None and not success:
+        logger.warning("Could not unregister {0} on delete.".format(
+            type(instance)
+        ))
+    elif error is not None and not isinstance(error, SNSException):
+        # Avoid that invalid arn token cause error when deleting instance
+        logger.warning("Could not unregister {0} on delete: {1}".format(
+            type(instance), error
+        ))
+
+
 @receiver(post_delete, sender=Device)
 @receiver(post_delete, sender=Platform)
 @receiver(post_delete, sender=Topic)
 @receiver(post_delete, sender=Subscription)
-def instance_deleted(sender, instance, **kwargs):
+def instance_deleted(sender, instance, using=None, **kwargs):
     """
-    Unregisters the instance from amazon sns.
+    Unregisters the instance from amazon sns. With
+    SCARFACE_DEREGISTER_ON_COMMIT the instances are collected and
+    deregistered concurrently once the transaction is committed.
     """
+    if not instance.is_registered:
+        return
+    if deregister_on_commit() and \
+            transaction.get_connection(using).in_atomic_block:
+        get_batch(using).append(instance)
+        return
     try:
-        if instance.is_registered and not instance.deregister(save=False):
+        if not instance.deregister(save=False):
             logger.warn("Could not unregister {0} on delete.".format(
                 sender
             ))
     except SNSException:
         # Avoid that invalid arn token cause error when deleting instance
         pass
+
+
+@receiver(post_save, sender=Application)
+@receiver(post_delete, sender=Application)
+@receiver(post_save, sender=Platform)
+@receiver(post_delete, sender=Platform)
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+def application_changed(sender, instance, **kwargs):
+    """
+    Drops the cached application of the changed instance.
+    """
+    if sender is Application:
+        application_cache.invalidate(instance.pk)
+    else:
+        application_cache.invalidate(instance.application_id)
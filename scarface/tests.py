@@ -4,19 +4,54 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+from contextlib import contextmanager
+from datetime import timedelta
+import asyncio
+import hashlib
+from io import StringIO
+import socket
+import threading
+import time
 import unittest
 import json
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from boto.exception import BotoServerError
-from django.test import TestCase
-from scarface.exceptions import PlatformNotSupported
-from scarface.platform_strategy import get_strategies, PlatformStrategy, APNPlatformStrategy
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, \
+    transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from scarface.aio import run_sync
+from scarface.bulk import send_to_devices, run_concurrently
+from scarface import push_log
+from scarface.outbox import process
+from scarface.connection import ScarfaceSNSConnection
+from scarface.application_cache import application_cache
+from scarface.circuit_breaker import CircuitBreaker, get_breaker
+from scarface.payload_cache import payload_cache, message_digest
+from scarface.payload_template import PayloadTemplate, FormattingTemplate
+from scarface.retry import is_retryable, backoff
+from scarface.serialization import dumps
+from scarface.throttling import TokenBucket, CacheTokenBucket, get_bucket
+from scarface.reconcile import reconcile_platform, reconcile_topic
+from scarface.exceptions import PlatformNotSupported, NotRegisteredException, \
+    SNSNotCreatedException, CircuitOpenException, PayloadTooLarge
+from scarface.platform_strategy import get_strategies, PlatformStrategy, APNPlatformStrategy, \
+    GCMPlatformStrategy, truncate_utf8
 from scarface.settings import SCARFACE_DEFAULT_PLATFORM_STRATEGIES
 from scarface.signals import instance_deleted
 from scarface.models import Application, Platform, Topic, Device, Subscription, \
     PushMessage
-from scarface.utils import DefaultConnection
+from scarface.utils import DefaultConnection, ConnectionManager, connect
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 TEST_ARN_TOKEN = 'test_arn_token'
 TEST_PUSH_TOKEN = 'test_push_token'
@@ -37,13 +72,7 @@ TEST_MESSAGE = 'test_message'
 TEST_APPLICATION_NAME = 'test_applicaiton'
 
 
-class BaseTestCase(TestCase):
-    def setUp(self):
-        pass
-
-    def tearDown(self):
-        pass
-
+class ModelsMixin(object):
     @property
     def application(self):
         return Application.objects.create(
@@ -92,6 +121,33 @@ class BaseTestCase(TestCase):
         )
 
 
+class BaseTestCase(ModelsMixin, TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    if not hasattr(TestCase, 'captureOnCommitCallbacks'):
+        # Added in Django 3.2
+        @classmethod
+        @contextmanager
+        def captureOnCommitCallbacks(cls, using=DEFAULT_DB_ALIAS,
+                                     execute=False):
+            callbacks = []
+            start_count = len(connections[using].run_on_commit)
+            try:
+                yield callbacks
+            finally:
+                callbacks[:] = [
+                    func for sids, func in
+                    connections[using].run_on_commit[start_count:]
+                ]
+                if execute:
+                    for callback in callbacks:
+                        callback()
+
+
 class ApplicationTestCase(BaseTestCase):
     def test_get_platform(self):
         app = self.application
@@ -274,6 +330,114 @@ class PlatformTestCase(BaseTestCase):
         )
         self.assertEqual(len(devices), 3)
 
+    def test_iter_devices(self):
+        app = self.application
+        platform = self.get_apns_platform(app)
+        for i in range(5):
+            Device.objects.create(
+                device_id=str(i),
+                platform=platform,
+                push_token=TEST_PUSH_TOKEN,
+                arn='arn_{0}'.format(i)
+            )
+
+        def page(arns, next_token):
+            return {
+                'ListEndpointsByPlatformApplicationResponse': {
+                    'ListEndpointsByPlatformApplicationResult': {
+                        'Endpoints': [{'EndpointArn': arn} for arn in arns],
+                        'NextToken': next_token
+                    }
+                }
+            }
+
+        connection = Mock()
+        connection.list_endpoints_by_platform_application.side_effect = [
+            page(['arn_0', 'arn_1', 'arn_unknown'], 'token'),
+            page(['arn_2', 'arn_3'], None),
+        ]
+
+        devices = platform.iter_devices(connection, chunk_size=2)
+        first = next(devices)
+        self.assertEqual(
+            connection.list_endpoints_by_platform_application.call_count, 1
+        )
+        with self.assertNumQueries(2):
+            rest = list(devices)
+
+        self.assertEqual(
+            sorted(device.arn for device in [first] + rest),
+            ['arn_0', 'arn_1', 'arn_2', 'arn_3']
+        )
+        connection.list_endpoints_by_platform_application.assert_called_with(
+            platform_application_arn=TEST_ARN_TOKEN_APNS,
+            next_token='token'
+        )
+
+    def test_register_devices(self):
+        EXISTING_ARN = 'arn:aws:sns:eu-west-1:123:endpoint/GCM/app/existing'
+        app = self.application
+        platform = self.get_gcm_platform(app)
+        known = Device.objects.create(
+            device_id='known',
+            platform=platform,
+            push_token='old_token'
+        )
+        registered = self.get_android_device(platform)
+
+        def create_platform_endpoint(platform_arn, token, custom_user_data):
+            if token == 'existing_token':
+                err = BotoServerError(400, 'Bad Request')
+                err.message = (
+                    'Invalid parameter: Token Reason: Endpoint {0} already '
+                    'exists with the same Token, but different '
+                    'attributes.'.format(EXISTING_ARN)
+                )
+                raise err
+            if token == 'invalid_token':
+                err = BotoServerError(400, 'Bad Request')
+                err.message = 'Invalid parameter: Token'
+                raise err
+            return {
+                'CreatePlatformEndpointResponse': {
+                    'CreatePlatformEndpointResult': {
+                        'EndpointArn': 'arn_{0}'.format(token)
+                    }
+                }
+            }
+
+        connection = Mock()
+        connection.create_platform_endpoint.side_effect = \
+            create_platform_endpoint
+
+        results = platform.register_devices(
+            [
+                ('known', 'new_token'),
+                registered,
+                ('new', 'existing_token'),
+                ('invalid', 'invalid_token'),
+            ],
+            custom_user_data='data',
+            connection=connection,
+            max_workers=2
+        )
+
+        self.assertEqual(len(results), 4)
+        errors = [result.error for result in results if not result.success]
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], SNSNotCreatedException)
+        self.assertEqual(
+            Device.objects.get(pk=known.pk).arn, 'arn_new_token'
+        )
+        self.assertEqual(
+            Device.objects.get(pk=known.pk).push_token, 'new_token'
+        )
+        self.assertEqual(
+            Device.objects.get(device_id='new').arn, EXISTING_ARN
+        )
+        self.assertIsNone(Device.objects.get(device_id='invalid').arn)
+        self.assertEqual(connection.set_endpoint_attributes.call_count, 2)
+
     def test_send_message(self):
         app = self.application
         platform = self.get_apns_platform(app)
@@ -387,6 +551,25 @@ class DeviceTestCase(BaseTestCase):
                 TEST_ARN_TOKEN_ANDROID_DEVICE
         )
 
+    def test_lookups(self):
+        app = self.application
+        gcm_device = self.get_android_device(self.get_gcm_platform(app))
+        apns_platform = self.get_apns_platform(app)
+        ios_device = self.get_ios_device(apns_platform)
+
+        self.assertEqual(
+            set(Device.objects.by_arns(iter([
+                TEST_ARN_TOKEN_ANDROID_DEVICE,
+                TEST_ARN_TOKEN_IOS_DEVICE,
+                'unknown'
+            ]))),
+            {gcm_device, ios_device}
+        )
+        self.assertEqual(
+            list(Device.objects.by_token(apns_platform, TEST_PUSH_TOKEN)),
+            [ios_device]
+        )
+
     def test_send_message(self):
         app = self.application
         platform = self.get_gcm_platform(app)
@@ -557,6 +740,113 @@ class TopicTestCase(BaseTestCase):
         except Subscription.DoesNotExist:
             pass
 
+    def test_register_devices(self):
+        app = self.application
+        platform = self.get_gcm_platform(app)
+        topic = self.get_topic(app)
+        device = self.get_android_device(platform)
+        subscribed = Device.objects.create(
+            device_id='subscribed', platform=platform, push_token='token',
+            arn='arn_subscribed'
+        )
+        Subscription.objects.create(topic=topic, device=subscribed,
+                                    arn='arn_subscription')
+        unregistered = Device.objects.create(
+            device_id='unregistered', platform=platform, push_token='token2'
+        )
+        connection = Mock()
+        connection.subscribe.return_value = {
+            'SubscribeResponse': {
+                'SubscribeResult': {'SubscriptionArn': 'arn_new'}
+            }
+        }
+
+        results = topic.register_devices(Device.objects.all(), connection)
+
+        connection.subscribe.assert_called_once_with(
+            topic=TEST_ARN_TOKEN_TOPIC,
+            endpoint=TEST_ARN_TOKEN_ANDROID_DEVICE,
+            protocol="application"
+        )
+        self.assertEqual(
+            sorted((r.device_pk, r.arn) for r in results if r.success),
+            [(device.pk, 'arn_new'), (subscribed.pk, 'arn_subscription')]
+        )
+        self.assertEqual(
+            [r.device_pk for r in results if not r.success],
+            [unregistered.pk]
+        )
+        self.assertEqual(
+            dict(topic.subscription_set.values_list('device_id', 'arn')),
+            {device.pk: 'arn_new', subscribed.pk: 'arn_subscription'}
+        )
+
+    def test_deregister_devices(self):
+        app = self.application
+        platform = self.get_gcm_platform(app)
+        topic = self.get_topic(app)
+        device = self.get_android_device(platform)
+        failing = Device.objects.create(
+            device_id='failing', platform=platform, push_token='token',
+            arn='arn_failing'
+        )
+        Subscription.objects.create(topic=topic, device=device, arn='arn_1')
+        Subscription.objects.create(topic=topic, device=failing,
+                                    arn='arn_fail')
+        connection = Mock()
+
+        def unsubscribe(arn):
+            if arn == 'arn_fail':
+                raise BotoServerError(500, 'Error')
+            return True
+        connection.unsubscribe.side_effect = unsubscribe
+
+        with self.captureOnCommitCallbacks(execute=True):
+            results = topic.deregister_devices(Device.objects.all(),
+                                               connection)
+
+        self.assertEqual(connection.unsubscribe.call_count, 2)
+        self.assertEqual([r.success for r in results], [True, False])
+        self.assertEqual(
+            list(topic.subscription_set.values_list('device_id', flat=True)),
+            [failing.pk]
+        )
+
+    def test_iter_subscriptions(self):
+        topic = self.get_topic(self.application)
+
+        def page(arns, next_token):
+            return {
+                'ListSubscriptionsByTopicResponse': {
+                    'ListSubscriptionsByTopicResult': {
+                        'Subscriptions': [
+                            {'SubscriptionArn': arn} for arn in arns
+                        ],
+                        'NextToken': next_token
+                    }
+                }
+            }
+
+        connection = Mock()
+        connection.get_all_subscriptions_by_topic.side_effect = [
+            page(['sub_1', 'sub_2'], 'token_2'),
+            page(['sub_3'], None),
+        ]
+
+        subscriptions = topic.iter_subscriptions(connection,
+                                                 start_token='token_1')
+        self.assertEqual(next(subscriptions)['SubscriptionArn'], 'sub_1')
+        connection.get_all_subscriptions_by_topic.assert_called_once_with(
+            topic=TEST_ARN_TOKEN_TOPIC, next_token='token_1'
+        )
+        self.assertEqual(
+            [subscription['SubscriptionArn'] for subscription in subscriptions],
+            ['sub_2', 'sub_3']
+        )
+        connection.get_all_subscriptions_by_topic.assert_called_with(
+            topic=TEST_ARN_TOKEN_TOPIC, next_token='token_2'
+        )
+
     def test_send(self):
         MESSAGE = 'test_message'
         app = self.application
@@ -573,22 +863,1272 @@ class TopicTestCase(BaseTestCase):
         self.assertTrue(connection.publish.called)
 
 
+class BulkSendTestCase(BaseTestCase):
+    def create_devices(self, platform, count, prefix):
+        return [
+            Device.objects.create(
+                device_id='{0}_{1}'.format(prefix, i),
+                platform=platform,
+                push_token=TEST_PUSH_TOKEN,
+                arn='{0}_arn_{1}'.format(prefix, i)
+            ) for i in range(count)
+        ]
+
+    def test_send_to_devices(self):
+        app = self.application
+        apns_devices = self.create_devices(self.get_apns_platform(app), 5,
+                                           'ios')
+        gcm_devices = self.create_devices(self.get_gcm_platform(app), 4,
+                                          'android')
+        unregistered = Device.objects.create(
+            device_id=TEST_DEVICE_ID,
+            platform=apns_devices[0].platform,
+            push_token=TEST_PUSH_TOKEN,
+        )
+        connection = Mock()
+        connection.publish.return_value = True
+        message = PushMessage(message=TEST_MESSAGE)
+
+        with patch.object(Platform, 'compile_payload',
+                          autospec=True,
+                          side_effect=lambda platform, message, slots:
+                          PayloadTemplate(platform.platform)) as compile:
+            results = Device.objects.all().send(
+                message,
+                connection=connection,
+                chunk_size=3,
+                max_workers=2
+            )
+
+        self.assertEqual(compile.call_count, 2)
+        self.assertEqual(connection.publish.call_count, 9)
+        self.assertEqual(len(results), 10)
+        failed = [result for result in results if not result.success]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].device_pk, unregistered.pk)
+        self.assertIsInstance(failed[0].error, NotRegisteredException)
+        published_arns = set(
+            call[1]['target_arn'] for call in
+            connection.publish.call_args_list
+        )
+        self.assertEqual(
+            published_arns,
+            set(device.arn for device in apns_devices + gcm_devices)
+        )
+        self.assertEqual(PushMessage.objects.count(), 9)
+
+    def test_send_to_devices_reports_errors(self):
+        app = self.application
+        devices = self.create_devices(self.get_gcm_platform(app), 2, 'android')
+        connection = Mock()
+        connection.publish.side_effect = [
+            True,
+            BotoServerError(400, 'Bad Request')
+        ]
+
+        results = send_to_devices(
+            Device.objects.filter(pk__in=[d.pk for d in devices]),
+            PushMessage(message=TEST_MESSAGE),
+            connection=connection,
+            max_workers=1
+        )
+
+        self.assertTrue(results[0].success)
+        self.assertIsInstance(results[1].error, BotoServerError)
+
+    def test_run_concurrently_shared_connection(self):
+        threads = set()
+
+        def call(item, connection):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            return item
+
+        results = list(run_concurrently(call, range(4), connection=Mock(),
+                                        max_workers=4))
+        self.assertEqual([r[1] for r in results], [0, 1, 2, 3])
+        self.assertEqual(len(threads), 1)
+
+    def test_send_to_devices_badges(self):
+        app = self.application
+        apns_devices = self.create_devices(self.get_apns_platform(app), 2,
+                                           'ios')
+        gcm_devices = self.create_devices(self.get_gcm_platform(app), 1,
+                                          'android')
+        connection = Mock()
+        message = PushMessage(message=TEST_MESSAGE, badge_count=1)
+
+        Device.objects.all().send(
+            message,
+            connection=connection,
+            max_workers=1,
+            badges={apns_devices[0].pk: 7, gcm_devices[0].pk: 3}
+        )
+
+        badges = dict()
+        for args in connection.publish.call_args_list:
+            platform, payload = json.loads(args[1]['message']).popitem()
+            payload = json.loads(payload)
+            badges[args[1]['target_arn']] = payload['aps']['badge'] \
+                if platform == 'APNS' else payload['data']['badge_count']
+        self.assertEqual(badges, {
+            apns_devices[0].arn: 7,
+            apns_devices[1].arn: 1,
+            gcm_devices[0].arn: 3,
+        })
+        self.assertEqual(
+            dict(PushMessage.objects.values_list('receiver_arn',
+                                                 'badge_count')),
+            badges
+        )
+
+    @override_settings(
+        SCARFACE_PLATFORM_STRATEGIES=['scarface.tests.BadgeStrategy']
+    )
+    def test_send_to_devices_badges_custom_strategy(self):
+        platform = Platform.objects.create(
+            platform='BADGE',
+            application=self.application,
+            credential=TEST_CREDENTIAL,
+            principal=TEST_PRINCIPAL,
+            arn=TEST_ARN_TOKEN_GCM
+        )
+        devices = self.create_devices(platform, 2, 'badge')
+        connection = Mock()
+        message = PushMessage(message=TEST_MESSAGE, badge_count=1)
+
+        Device.objects.all().send(
+            message,
+            connection=connection,
+            max_workers=1,
+            badges={devices[0].pk: 7}
+        )
+
+        badges = dict(
+            (args[1]['target_arn'],
+             json.loads(json.loads(args[1]['message'])['BADGE'])['badge'])
+            for args in connection.publish.call_args_list
+        )
+        self.assertEqual(badges, {devices[0].arn: 7, devices[1].arn: 1})
+
+
+@override_settings(AWS_ACCESS_KEY='access_key',
+                   AWS_SECRET_ACCESS_KEY='secret_key',
+                   SCARFACE_REGION_NAME='eu-west-1',
+                   SCARFACE_CONNECTION_POOL_SIZE=1)
+class ConnectionManagerTestCase(TestCase):
+    def setUp(self):
+        self.factory = Mock(side_effect=lambda *key: Mock())
+        self.manager = ConnectionManager(factory=self.factory)
+
+    def test_reuses_released_connection(self):
+        with self.manager.connection() as first:
+            pass
+        with self.manager.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.factory.assert_called_once_with(
+            'eu-west-1', 'access_key', 'secret_key'
+        )
+
+    def test_pool_size(self):
+        with self.manager.connection() as first:
+            with self.manager.connection() as second:
+                self.assertIsNot(first, second)
+
+        self.assertFalse(second.close.called)
+        first.close.assert_called_once_with()
+
+    def test_keyed_by_credentials(self):
+        with self.manager.connection() as first:
+            pass
+        with override_settings(AWS_ACCESS_KEY='other_key'):
+            with self.manager.connection() as second:
+                pass
+
+        self.assertIsNot(first, second)
+
+    def test_reset(self):
+        with self.manager.connection() as in_use:
+            with self.manager.connection() as idle:
+                pass
+            self.manager.reset()
+            idle.close.assert_called_once_with()
+            self.assertFalse(in_use.close.called)
+        in_use.close.assert_called_once_with()
+
+        with self.manager.connection() as new:
+            pass
+        self.assertNotIn(new, (idle, in_use))
+
+
+class DecoratorTestCase(TestCase):
+    def test_explicit_connection(self):
+        connection = Mock()
+        with patch('scarface.utils.connection_manager') as manager:
+            self.assertEqual(connection_test(1, connection), (1, connection))
+            self.assertEqual(connection_test(a=2, connection=connection),
+                             (2, connection))
+            self.assertFalse(manager.connection.called)
+
+    def test_default_connection(self):
+        connection = Mock()
+        with patch('scarface.utils.connection_manager') as manager:
+            manager.connection.return_value.__enter__.return_value = \
+                connection
+            self.assertEqual(connection_test(), (None, connection))
+            self.assertEqual(connection_test(1, None), (1, connection))
+            self.assertEqual(connection_test(a=2), (2, connection))
+
+    def test_default_connection_generator(self):
+        @DefaultConnection
+        def generate(connection=None):
+            yield connection
+            yield connection
+
+        with patch('scarface.utils.connection_manager') as manager:
+            context = manager.connection.return_value
+            values = generate()
+            self.assertFalse(manager.connection.called)
+            self.assertIs(next(values), context.__enter__.return_value)
+            self.assertFalse(context.__exit__.called)
+            list(values)
+            self.assertTrue(context.__exit__.called)
+
+    @override_settings(SCARFACE_LOGGING_ENABLED=False)
+    def test_push_logger_signs_bound_instance(self):
+        first = Device(arn=TEST_ARN_TOKEN_IOS_DEVICE)
+        second = Device(arn=TEST_ARN_TOKEN_ANDROID_DEVICE)
+        first_send = first.send
+        second_send = second.send
+        message = PushMessage(message=TEST_MESSAGE)
+
+        platform = Mock()
+        platform.format_payload.return_value = {}
+        with patch.object(Device, 'platform', platform):
+            first_send(message, connection=Mock())
+            self.assertEqual(message.receiver_arn, TEST_ARN_TOKEN_IOS_DEVICE)
+            second_send(push_message=message, connection=Mock())
+            self.assertEqual(message.receiver_arn,
+                             TEST_ARN_TOKEN_ANDROID_DEVICE)
+
+
+class AsyncTestCase(TestCase):
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @override_settings(SCARFACE_LOGGING_ENABLED=False)
+    def test_asend(self):
+        device = Device(arn=TEST_ARN_TOKEN_ANDROID_DEVICE)
+        platform = Mock()
+        platform.format_payload.return_value = {'GCM': '{}'}
+        connection = Mock()
+        connection.publish.return_value = True
+
+        with patch.object(Device, 'platform', platform):
+            result = self.run_async(device.asend(
+                PushMessage(message=TEST_MESSAGE),
+                connection=connection
+            ))
+
+        self.assertTrue(result)
+        connection.publish.assert_called_once_with(
+            message='{"GCM":"{}"}',
+            target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+            message_structure='json'
+        )
+
+    @override_settings(SCARFACE_ASYNC_MAX_CONCURRENCY=2)
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        counter = {'current': 0, 'max': 0}
+
+        def blocking_call(value):
+            with lock:
+                counter['current'] += 1
+                counter['max'] = max(counter['max'], counter['current'])
+            time.sleep(0.02)
+            with lock:
+                counter['current'] -= 1
+            return value
+
+        async def run_all():
+            return await asyncio.gather(
+                *[run_sync(blocking_call, i) for i in range(6)]
+            )
+
+        self.assertEqual(self.run_async(run_all()), list(range(6)))
+        self.assertEqual(counter['max'], 2)
+
+
+class ReconcileTestCase(BaseTestCase):
+    def setUp(self):
+        app = self.application
+        self.platform = self.get_gcm_platform(app)
+        self.topic = self.get_topic(app)
+        self.devices = [
+            Device.objects.create(
+                device_id=str(i),
+                platform=self.platform,
+                push_token=TEST_PUSH_TOKEN,
+                arn='arn_{0}'.format(i)
+            ) for i in range(4)
+        ]
+        self.connection = Mock()
+        self.connection.list_endpoints_by_platform_application.return_value = {
+            'ListEndpointsByPlatformApplicationResponse': {
+                'ListEndpointsByPlatformApplicationResult': {
+                    'Endpoints': [
+                        {'EndpointArn': 'arn_0'},
+                        {'EndpointArn': 'arn_1'},
+                        {'EndpointArn': 'arn_2'},
+                        {'EndpointArn': 'arn_orphan',
+                         'Attributes': {'Enabled': 'false'}},
+                    ],
+                    'NextToken': None
+                }
+            }
+        }
+        self.connection.get_all_subscriptions_by_topic.return_value = {
+            'ListSubscriptionsByTopicResponse': {
+                'ListSubscriptionsByTopicResult': {
+                    'Subscriptions': [
+                        {'SubscriptionArn': 'sub_0', 'Endpoint': 'arn_0',
+                         'Protocol': 'application'},
+                        {'SubscriptionArn': 'sub_1', 'Endpoint': 'arn_1',
+                         'Protocol': 'application'},
+                        {'SubscriptionArn': 'sub_2', 'Endpoint': 'arn_2',
+                         'Protocol': 'application'},
+                        {'SubscriptionArn': 'sub_orphan',
+                         'Endpoint': 'arn_orphan',
+                         'Protocol': 'application'},
+                    ],
+                    'NextToken': None
+                }
+            }
+        }
+
+    def test_reconcile_platform(self):
+        report = reconcile_platform(self.platform, connection=self.connection,
+                                    chunk_size=2)
+
+        self.assertEqual(report.remote, 4)
+        self.assertEqual(report.local, 4)
+        self.assertEqual(report.orphaned, 1)
+        self.assertEqual(report.stale, 1)
+        self.assertEqual(report.disabled, 1)
+        self.assertEqual(report.samples['stale'], ['arn_3'])
+        self.assertEqual(report.fixed, 0)
+        self.assertFalse(self.connection.delete_endpoint.called)
+
+        self.connection.get_endpoint_attributes.side_effect = \
+            lambda arn: self.raise_not_found()
+        report = reconcile_platform(self.platform, apply=True,
+                                    delete_orphans=True,
+                                    connection=self.connection, chunk_size=2)
+
+        self.assertEqual(report.fixed, 2)
+        self.connection.get_endpoint_attributes.assert_called_once_with(
+            'arn_3')
+        self.connection.delete_endpoint.assert_called_once_with('arn_orphan')
+        self.assertIsNone(Device.objects.get(pk=self.devices[3].pk).arn)
+
+    def test_reconcile_platform_registration(self):
+        listing = self.connection.list_endpoints_by_platform_application
+        listed = listing.return_value
+        unregistered = self.devices[0]
+        unregistered.arn = None
+        unregistered.save()
+
+        def register(*args, **kwargs):
+            # Devices registered while SNS is listed
+            Device.objects.create(device_id='new', platform=self.platform,
+                                  push_token=TEST_PUSH_TOKEN, arn='arn_new')
+            unregistered.arn = 'arn_registered'
+            unregistered.save()
+            return listed
+
+        listing.side_effect = register
+        self.connection.get_endpoint_attributes.side_effect = \
+            lambda arn: {} if arn == 'arn_registered' else \
+            self.raise_not_found()
+        report = reconcile_platform(self.platform, apply=True,
+                                    connection=self.connection)
+
+        self.assertEqual(report.local, 4)
+        self.assertEqual(report.stale, 2)
+        self.assertEqual(report.fixed, 1)
+        self.assertEqual(
+            list(Device.objects.filter(arn__isnull=True).values_list(
+                'device_id', flat=True)),
+            ['3']
+        )
+
+    def test_reconcile_platform_orphans(self):
+        listing = self.connection.list_endpoints_by_platform_application
+        listed = listing.return_value
+        result = listed['ListEndpointsByPlatformApplicationResponse'][
+            'ListEndpointsByPlatformApplicationResult']
+        first = dict(result, NextToken='next', Endpoints=[
+            {'EndpointArn': 'arn_saved', 'Attributes': {'Token': 'saved'}},
+            {'EndpointArn': 'arn_token',
+             'Attributes': {'Token': TEST_PUSH_TOKEN}},
+        ])
+
+        def save(*args, **kwargs):
+            # Saved after its endpoint was created and listed
+            Device.objects.create(device_id='saved', platform=self.platform,
+                                  push_token='saved', arn='arn_saved')
+            return listed
+
+        listing.side_effect = lambda *args, **kwargs: (
+            save() if kwargs.get('next_token') else
+            {'ListEndpointsByPlatformApplicationResponse': {
+                'ListEndpointsByPlatformApplicationResult': first}}
+        )
+        report = reconcile_platform(self.platform, delete_orphans=True,
+                                    connection=self.connection, chunk_size=1)
+
+        self.assertEqual(report.orphaned, 3)
+        self.assertEqual(report.fixed, 1)
+        self.connection.delete_endpoint.assert_called_once_with('arn_orphan')
+
+    def raise_not_found(self):
+        raise BotoServerError(404, 'Not Found', json.dumps(
+            {'Error': {'Code': 'NotFound'}}
+        ))
+
+    def test_reconcile_topic(self):
+        late = Device.objects.create(device_id='late', platform=self.platform,
+                                     push_token=TEST_PUSH_TOKEN,
+                                     arn='arn_late')
+        unsubscribed = Subscription.objects.create(topic=self.topic,
+                                                   device=late)
+        Subscription.objects.create(topic=self.topic, device=self.devices[0],
+                                    arn='sub_0')
+        Subscription.objects.create(topic=self.topic, device=self.devices[1],
+                                    arn='sub_outdated')
+        Subscription.objects.create(topic=self.topic, device=self.devices[3],
+                                    arn='sub_stale')
+
+        listing = self.connection.get_all_subscriptions_by_topic
+        listed = listing.return_value
+
+        def subscribe(*args, **kwargs):
+            # Subscribed while SNS is listed
+            device = Device.objects.create(device_id='new',
+                                           platform=self.platform,
+                                           push_token=TEST_PUSH_TOKEN,
+                                           arn='arn_new')
+            Subscription.objects.create(topic=self.topic, device=device,
+                                        arn='sub_new')
+            unsubscribed.arn = 'sub_late'
+            unsubscribed.save()
+            listing.side_effect = relist
+            return listed
+
+        def relist(*args, **kwargs):
+            result = listed['ListSubscriptionsByTopicResponse'][
+                'ListSubscriptionsByTopicResult']
+            return {'ListSubscriptionsByTopicResponse': {
+                'ListSubscriptionsByTopicResult': dict(
+                    result, Subscriptions=result['Subscriptions'] + [
+                        {'SubscriptionArn': 'sub_late',
+                         'Endpoint': 'arn_late', 'Protocol': 'application'}
+                    ]
+                )
+            }}
+
+        listing.side_effect = subscribe
+        report = reconcile_topic(self.topic, apply=True, delete_orphans=True,
+                                 connection=self.connection, chunk_size=3)
+
+        self.assertEqual(report.remote, 4)
+        self.assertEqual(report.linked, 2)
+        self.assertEqual(report.orphaned, 1)
+        self.assertEqual(report.stale, 2)
+        self.assertEqual(report.samples['stale'], ['sub_late', 'sub_stale'])
+        self.assertEqual(listing.call_count, 2)
+        self.connection.unsubscribe.assert_called_once_with('sub_orphan')
+        self.assertEqual(
+            dict(Subscription.objects.values_list('device_id', 'arn')),
+            {
+                late.pk: 'sub_late',
+                self.devices[0].pk: 'sub_0',
+                self.devices[1].pk: 'sub_1',
+                self.devices[2].pk: 'sub_2',
+                self.devices[3].pk: None,
+                Device.objects.get(device_id='new').pk: 'sub_new',
+            }
+        )
+
+    def test_command(self):
+        out = StringIO()
+        with patch('scarface.utils.connection_manager') as manager:
+            manager.connection.return_value.__enter__.return_value = \
+                self.connection
+            call_command('scarface_reconcile', stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('1 orphaned, 1 stale', output)
+        self.assertIn('3 linked', output)
+        self.assertFalse(self.connection.delete_endpoint.called)
+
+
+class OutboxTestCase(BaseTestCase):
+    def setUp(self):
+        app = self.application
+        self.device = self.get_android_device(self.get_gcm_platform(app))
+        self.topic = self.get_topic(app)
+        self.connection = Mock()
+
+    def test_enqueue(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        self.device.enqueue(message)
+
+        message.refresh_from_db()
+        self.assertEqual(message.status, PushMessage.STATUS_QUEUED)
+        self.assertEqual(message.receiver_arn, TEST_ARN_TOKEN_ANDROID_DEVICE)
+        self.assertIsNotNone(message.next_attempt)
+        self.assertFalse(self.connection.publish.called)
+
+        with self.assertRaises(NotRegisteredException):
+            Device(arn=None).enqueue(PushMessage(message=TEST_MESSAGE))
+
+    def test_deliver(self):
+        device_message = PushMessage(message=TEST_MESSAGE)
+        self.device.enqueue(device_message)
+        topic_message = PushMessage(message=TEST_MESSAGE)
+        self.topic.enqueue(topic_message)
+
+        self.assertEqual(process(10, connection=self.connection), 2)
+
+        self.assertEqual(self.connection.publish.call_count, 2)
+        self.assertEqual(
+            set(PushMessage.objects.values_list('status', 'attempts')),
+            {(PushMessage.STATUS_SENT, 1)}
+        )
+        self.assertEqual(process(10, connection=self.connection), 0)
+
+    def test_deliver_extra_payload(self):
+        ios_device = self.get_ios_device(
+            self.get_apns_platform(self.device.platform.application))
+        for device in (self.device, ios_device):
+            device.enqueue(PushMessage(message=TEST_MESSAGE,
+                                       extra_payload={'url': 'x'}))
+        self.assertEqual(
+            list(PushMessage.objects.values_list('extra_payload', flat=True)),
+            [{'url': 'x'}] * 2
+        )
+
+        self.assertEqual(process(10, connection=self.connection), 2)
+
+        self.assertEqual(self.connection.publish.call_count, 2)
+        for args in self.connection.publish.call_args_list:
+            platform, payload = json.loads(args[1]['message']).popitem()
+            self.assertIn('"url":"x"', payload.replace(' ', ''))
+        self.assertEqual(
+            set(PushMessage.objects.values_list('status', flat=True)),
+            {PushMessage.STATUS_SENT}
+        )
+
+    @override_settings(SCARFACE_OUTBOX_MAX_ATTEMPTS=2)
+    def test_retry(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        self.device.enqueue(message)
+        self.connection.publish.side_effect = BotoServerError(500, 'Error')
+
+        self.assertEqual(process(10, connection=self.connection), 1)
+        message.refresh_from_db()
+        self.assertEqual(message.status, PushMessage.STATUS_QUEUED)
+        self.assertGreater(message.next_attempt, timezone.now())
+        self.assertEqual(process(10, connection=self.connection), 0)
+
+        PushMessage.objects.update(next_attempt=timezone.now())
+        self.assertEqual(process(10, connection=self.connection), 1)
+        message.refresh_from_db()
+        self.assertEqual(message.status, PushMessage.STATUS_FAILED)
+        self.assertEqual(message.attempts, 2)
+        self.assertIn('500', message.last_error)
+
+    def test_unknown_receiver(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        self.device.enqueue(message)
+        Device.objects.filter(pk=self.device.pk).update(arn=None)
+
+        process(10, connection=self.connection)
+
+        message.refresh_from_db()
+        self.assertEqual(message.status, PushMessage.STATUS_FAILED)
+        self.assertFalse(self.connection.publish.called)
+
+    def test_command(self):
+        self.device.enqueue(PushMessage(message=TEST_MESSAGE))
+        out = StringIO()
+        with patch('scarface.bulk.connection_manager') as manager:
+            manager.connection.return_value.__enter__.return_value = \
+                self.connection
+            call_command('scarface_worker', once=True, stdout=out)
+
+        self.assertIn('Processed 1 push messages', out.getvalue())
+        self.assertTrue(self.connection.publish.called)
+
+
+@override_settings(SCARFACE_LOGGING_MODE='buffered',
+                   SCARFACE_LOGGING_BUFFER_SIZE=3,
+                   SCARFACE_LOGGING_FLUSH_INTERVAL=60)
+class PushLogTestCase(ModelsMixin, TransactionTestCase):
+    # The buffer is written outside of transactions only, so these tests
+    # run without the transaction of TestCase.
+    def setUp(self):
+        push_log.buffer.flush()
+        push_log.buffer._timer = None
+        push_log.buffer._retry_at = 0
+        timer = patch('scarface.push_log.threading.Timer')
+        self.timer = timer.start()
+        self.addCleanup(timer.stop)
+        app = self.application
+        self.device = self.get_android_device(self.get_gcm_platform(app))
+        self.connection = Mock()
+
+    def send(self, count=1):
+        for i in range(count):
+            self.device.send(PushMessage(message=TEST_MESSAGE),
+                             self.connection)
+
+    def test_flush_on_size(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        self.device.send(message, self.connection)
+        self.device.send(message, self.connection)
+        self.assertEqual(PushMessage.objects.count(), 0)
+        self.assertIsNone(message.pk)
+
+        self.device.send(message, self.connection)
+        self.assertEqual(PushMessage.objects.count(), 3)
+        self.assertEqual(len(push_log.buffer), 0)
+
+    def test_flush_on_interval(self):
+        with override_settings(SCARFACE_LOGGING_FLUSH_INTERVAL=0):
+            self.send()
+        self.assertEqual(PushMessage.objects.count(), 1)
+
+    def test_flush_on_commit(self):
+        with transaction.atomic():
+            self.send(2)
+            self.assertEqual(PushMessage.objects.count(), 0)
+            self.send(2)
+            self.assertEqual(PushMessage.objects.count(), 0)
+            self.assertEqual(len(push_log.buffer), 4)
+
+        self.assertEqual(
+            list(PushMessage.objects.values_list('receiver_arn', flat=True)),
+            [TEST_ARN_TOKEN_ANDROID_DEVICE] * 4
+        )
+
+    def test_rollback(self):
+        self.send()
+        try:
+            with transaction.atomic():
+                self.send(3)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(PushMessage.objects.count(), 0)
+        self.assertEqual(len(push_log.buffer), 4)
+
+        push_log.buffer.flush()
+        self.assertEqual(PushMessage.objects.count(), 4)
+
+    def test_flush_on_request_finished(self):
+        self.send()
+        self.assertEqual(PushMessage.objects.count(), 0)
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(PushMessage.objects.count(), 1)
+
+    def test_flush_on_timer(self):
+        self.send(2)
+        self.assertEqual(self.timer.call_count, 1)
+        self.assertEqual(self.timer.call_args[0][0], 60)
+        with patch('scarface.push_log.connections.close_all') as close_all:
+            self.timer.call_args[0][1]()
+        self.assertTrue(close_all.called)
+        self.assertEqual(PushMessage.objects.count(), 2)
+        self.assertIsNone(push_log.buffer._timer)
+
+    def test_flush_failure(self):
+        self.send()
+        with patch.object(PushMessage.objects, 'bulk_create',
+                          side_effect=DatabaseError):
+            push_log.buffer.flush()
+        self.assertEqual(len(push_log.buffer), 1)
+        push_log.buffer.flush()
+        self.assertEqual(PushMessage.objects.count(), 1)
+
+    @override_settings(SCARFACE_LOGGING_MAX_BACKLOG=5)
+    def test_backlog(self):
+        with patch.object(PushMessage.objects, 'bulk_create',
+                          side_effect=DatabaseError) as bulk_create, \
+                self.assertLogs('django_scarface', 'WARNING') as logs:
+            self.send(10)
+            request_finished.send(sender=self.__class__)
+
+        # No retry before the flush interval has passed
+        self.assertEqual(bulk_create.call_count, 1)
+        self.assertEqual(len(push_log.buffer), 5)
+        self.assertIn('dropped', logs.output[-1])
+
+        self.timer.call_args[0][1]()
+        self.assertEqual(PushMessage.objects.count(), 5)
+        self.assertEqual(len(push_log.buffer), 0)
+
+    def test_purge(self):
+        old = timezone.now() - timedelta(days=31)
+        PushMessage.objects.bulk_create(
+            [PushMessage(message=TEST_MESSAGE, created=old)
+             for i in range(5)] +
+            [PushMessage(message=TEST_MESSAGE,
+                         status=PushMessage.STATUS_QUEUED, created=old),
+             PushMessage(message=TEST_MESSAGE)]
+        )
+
+        out = StringIO()
+        with override_settings(SCARFACE_LOG_RETENTION_DAYS=30):
+            call_command('scarface_purge_logs', chunk_size=2, stdout=out)
+
+        self.assertIn('Deleted 5 push messages', out.getvalue())
+        self.assertEqual(
+            list(PushMessage.objects.order_by('pk').values_list(
+                'status', flat=True)),
+            [PushMessage.STATUS_QUEUED, PushMessage.STATUS_LOGGED]
+        )
+        self.assertEqual(push_log.purge(days=0), 1)
+
+
+class ThrottlingTestCase(TestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = TokenBucket(2, capacity=3, clock=lambda: now[0])
+
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+
+        now[0] = 10.0
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_cache_token_bucket(self):
+        caches['default'].clear()
+        now = [100.5]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        # Two buckets with the same key act like two processes
+        first, second = [
+            CacheTokenBucket('test', 10, lease=4, cache='default',
+                             clock=lambda: now[0])
+            for i in range(2)
+        ]
+        with patch('scarface.throttling.time.sleep', side_effect=sleep):
+            # The leases grow with the use, 1, 1, 2 and 4 tokens
+            for i in range(5):
+                self.assertEqual(first.acquire(), 0)
+            self.assertEqual(caches['default'].get('test:100'), 8)
+            for i in range(2):
+                self.assertEqual(second.acquire(), 0)
+            self.assertEqual((first.tokens, second.tokens), (3, 0))
+
+            # The budget of the second is used up
+            self.assertEqual(second.acquire(), 0.5)
+            self.assertEqual(caches['default'].get('test:100'), 12)
+            self.assertEqual(now[0], 101)
+            self.assertEqual(caches['default'].get('test:101'), 1)
+
+            # Leased tokens expire with their second
+            self.assertEqual(first.acquire(), 0)
+            self.assertEqual(first.window, 101)
+            self.assertEqual(caches['default'].get('test:101'), 2)
+
+            # Many processes which call once per second get the whole rate
+            others = [
+                CacheTokenBucket('test', 10, lease=4, cache='default',
+                                 clock=lambda: now[0])
+                for i in range(8)
+            ]
+            for bucket in others:
+                self.assertEqual(bucket.acquire(), 0)
+            self.assertEqual(now[0], 101)
+
+    @override_settings(SCARFACE_RATE_LIMIT_BACKEND='cache',
+                       SCARFACE_RATE_LIMITS={'Publish': 5})
+    def test_cache_backend(self):
+        bucket = get_bucket('eu-west-1', 'Publish')
+        self.assertIsInstance(bucket, CacheTokenBucket)
+        self.assertEqual(bucket.key, 'scarface:ratelimit:eu-west-1:Publish')
+        self.assertEqual(bucket.lease, 5)
+        self.assertIsNone(get_bucket('eu-west-1', 'Subscribe'))
+
+        with override_settings(SCARFACE_RATE_LIMITS={'Publish': (5, 10)}):
+            with self.assertRaises(ImproperlyConfigured):
+                get_bucket('eu-west-1', 'Publish')
+
+    @override_settings(SCARFACE_RATE_LIMITS={'Publish': (1, 1)})
+    def test_connection_throttles(self):
+        connection = connect('eu-west-1', 'key', 'secret')
+        self.assertIsInstance(connection, ScarfaceSNSConnection)
+
+        with patch('boto.sns.connection.SNSConnection._make_request') as make, \
+                patch('scarface.throttling.time.sleep') as sleep:
+            connection.publish(target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+                               message=TEST_MESSAGE)
+            self.assertFalse(sleep.called)
+            connection.publish(target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+                               message=TEST_MESSAGE)
+            self.assertEqual(sleep.call_count, 1)
+            self.assertAlmostEqual(sleep.call_args[0][0], 1, places=1)
+
+            connection.create_topic('topic')
+            self.assertEqual(sleep.call_count, 1)
+            self.assertEqual(make.call_count, 3)
+
+
+class RetryTestCase(TestCase):
+    def setUp(self):
+        self.connection = connect('eu-west-1', 'key', 'secret')
+
+    def error(self, status, code):
+        return BotoServerError(status, 'Error', json.dumps(
+            {'Error': {'Code': code, 'Message': code}}
+        ))
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(self.error(400, 'Throttling')))
+        self.assertTrue(is_retryable(self.error(503, 'Unavailable')))
+        self.assertTrue(is_retryable(self.error(429, 'Unknown')))
+        self.assertFalse(is_retryable(self.error(400, 'InvalidParameter')))
+        self.assertFalse(is_retryable(self.error(400, 'EndpointDisabled')))
+        self.assertTrue(is_retryable(socket.error('reset')))
+        self.assertFalse(is_retryable(ValueError()))
+
+    @override_settings(SCARFACE_RETRY_BASE_DELAY=1,
+                       SCARFACE_RETRY_MAX_DELAY=3)
+    def test_backoff(self):
+        with patch('scarface.retry.random.uniform') as uniform:
+            for attempt in range(1, 5):
+                backoff(attempt)
+            self.assertEqual(
+                [args[0] for args in uniform.call_args_list],
+                [(0, 1), (0, 2), (0, 3), (0, 3)]
+            )
+
+    def test_retries_transient_errors(self):
+        with patch('boto.sns.connection.SNSConnection._make_request',
+                   side_effect=[self.error(400, 'Throttling'),
+                                self.error(500, 'InternalError'),
+                                {'PublishResponse': {}}]) as make, \
+                patch('scarface.connection.time.sleep') as sleep:
+            response = self.connection.publish(
+                target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE, message=TEST_MESSAGE
+            )
+        self.assertEqual(response, {'PublishResponse': {}})
+        self.assertEqual(make.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    @override_settings(SCARFACE_RETRY_MAX_ATTEMPTS=2)
+    def test_gives_up(self):
+        with patch('boto.sns.connection.SNSConnection._make_request',
+                   side_effect=self.error(400, 'Throttling')) as make, \
+                patch('scarface.connection.time.sleep'):
+            with self.assertRaises(BotoServerError):
+                self.connection.publish(
+                    target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+                    message=TEST_MESSAGE
+                )
+        self.assertEqual(make.call_count, 2)
+
+        with patch('boto.sns.connection.SNSConnection._make_request',
+                   side_effect=self.error(400, 'InvalidParameter')) as make:
+            with self.assertRaises(BotoServerError):
+                self.connection.publish(
+                    target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+                    message=TEST_MESSAGE
+                )
+        self.assertEqual(make.call_count, 1)
+
+    def http_connection(self, status, body=b''):
+        http = Mock()
+        response = http.getresponse.return_value
+        response.status = status
+        response.reason = 'Reason'
+        response.read.return_value = body
+        response.getheader.return_value = None
+        return http
+
+    @override_settings(SCARFACE_RETRY_MAX_ATTEMPTS=3)
+    def test_single_request_per_attempt(self):
+        http = self.http_connection(503)
+        with patch.object(self.connection, 'get_http_connection',
+                          return_value=http), \
+                patch.object(self.connection, 'new_http_connection',
+                             return_value=http), \
+                patch('scarface.connection.throttle') as throttle, \
+                patch('time.sleep') as sleep:
+            with self.assertRaises(BotoServerError):
+                self.connection.publish(
+                    target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE,
+                    message=TEST_MESSAGE
+                )
+        self.assertEqual(http.request.call_count, 3)
+        self.assertEqual(throttle.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_retries_connection_errors(self):
+        http = self.http_connection(200, b'{"PublishResponse": {}}')
+        http.request.side_effect = [socket.error('reset'), None]
+        with patch.object(self.connection, 'get_http_connection',
+                          return_value=http), \
+                patch.object(self.connection, 'new_http_connection',
+                             return_value=http), \
+                patch('time.sleep') as sleep:
+            response = self.connection.publish(
+                target_arn=TEST_ARN_TOKEN_ANDROID_DEVICE, message=TEST_MESSAGE
+            )
+        self.assertEqual(response, {'PublishResponse': {}})
+        self.assertEqual(http.request.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+
+@override_settings(SCARFACE_CIRCUIT_BREAKER_THRESHOLD=2,
+                   SCARFACE_CIRCUIT_BREAKER_COOLDOWN=30)
+class CircuitBreakerTestCase(BaseTestCase):
+    def setUp(self):
+        app = self.application
+        self.platform = self.get_gcm_platform(app)
+        self.device = self.get_android_device(self.platform)
+        self.connection = Mock()
+        self.disabled = BotoServerError(400, 'Error', json.dumps(
+            {'Error': {'Code': 'PlatformApplicationDisabled'}}
+        ))
+
+    def fail(self, breaker, error):
+        with self.assertRaises(type(error)):
+            with breaker:
+                raise error
+
+    def test_states(self):
+        now = [0]
+        breaker = CircuitBreaker('arn', clock=lambda: now[0])
+
+        self.fail(breaker, self.disabled)
+        self.fail(breaker, BotoServerError(400, 'EndpointDisabled'))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+        self.fail(breaker, self.disabled)
+        self.fail(breaker, self.disabled)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.fail(breaker, CircuitOpenException())
+
+        now[0] = 30
+        self.fail(breaker, self.disabled)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 60
+        with breaker:
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            # Only one probe at a time
+            self.fail(breaker, CircuitOpenException())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_device_send(self):
+        self.connection.publish.side_effect = self.disabled
+        for i in range(2):
+            with self.assertRaises(BotoServerError):
+                self.device.send(PushMessage(message=TEST_MESSAGE),
+                                 self.connection)
+        with self.assertRaises(CircuitOpenException):
+            self.device.send(PushMessage(message=TEST_MESSAGE),
+                             self.connection)
+        self.assertEqual(self.connection.publish.call_count, 2)
+
+        results = Device.objects.all().send(
+            PushMessage(message=TEST_MESSAGE), self.connection
+        )
+        self.assertIsInstance(results[0].error, CircuitOpenException)
+        self.assertEqual(self.connection.publish.call_count, 2)
+
+    def test_outbox_retries_open_circuit(self):
+        get_breaker(TEST_ARN_TOKEN_GCM).state = CircuitBreaker.OPEN
+        get_breaker(TEST_ARN_TOKEN_GCM).opened = time.monotonic()
+        message = PushMessage(message=TEST_MESSAGE)
+        self.device.enqueue(message)
+
+        process(10, connection=self.connection)
+
+        message.refresh_from_db()
+        self.assertEqual(message.status, PushMessage.STATUS_QUEUED)
+        self.assertFalse(self.connection.publish.called)
+
+
+class DeregisterOnDeleteTestCase(BaseTestCase):
+    def setUp(self):
+        app = self.application
+        self.platform = self.get_gcm_platform(app)
+        self.device = self.get_android_device(self.platform)
+
+    def test_deregister_on_commit(self):
+        with patch('scarface.bulk.connection_manager') as manager:
+            connection = manager.connection.return_value.__enter__.return_value
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.platform.delete()
+                self.assertFalse(connection.delete_endpoint.called)
+
+        self.assertEqual(len(callbacks), 1)
+        connection.delete_endpoint.assert_called_once_with(
+            TEST_ARN_TOKEN_ANDROID_DEVICE
+        )
+        connection.delete_platform_application.assert_called_once_with(
+            TEST_ARN_TOKEN_GCM
+        )
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    Device.objects.all().delete()
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+
+    @override_settings(SCARFACE_DEREGISTER_ON_COMMIT=False)
+    def test_deregister_immediately(self):
+        with patch('scarface.utils.connection_manager') as manager:
+            connection = manager.connection.return_value.__enter__.return_value
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.device.delete()
+
+        self.assertEqual(callbacks, [])
+        connection.delete_endpoint.assert_called_once_with(
+            TEST_ARN_TOKEN_ANDROID_DEVICE
+        )
+
+
+@override_settings(SCARFACE_LOGGING_ENABLED=False)
+class ApplicationCacheTestCase(BaseTestCase):
+    def setUp(self):
+        application_cache.invalidate()
+        self.app = app = self.application
+        self.platform = self.get_gcm_platform(app)
+        self.topic = self.get_topic(app)
+        self.connection = Mock()
+
+    def test_lookups(self):
+        app = self.app
+        with self.assertNumQueries(3):
+            self.assertEqual(app.get_platform('GCM'), self.platform)
+            self.assertEqual(app.get_topic(TEST_TOPIC_NAME), self.topic)
+            self.assertEqual(self.platform.name,
+                             TEST_APPLICATION_NAME + '_gcm')
+        with self.assertNumQueries(0):
+            self.assertEqual(app.get_platform('GCM'), self.platform)
+            self.assertEqual(app.get_topic(TEST_TOPIC_NAME), self.topic)
+            self.assertEqual(self.platform.name,
+                             TEST_APPLICATION_NAME + '_gcm')
+            self.assertEqual(self.topic.full_name,
+                             TEST_APPLICATION_NAME + '_' + TEST_TOPIC_NAME)
+            with self.assertRaises(PlatformNotSupported):
+                app.get_platform('APNS')
+
+    def test_copies(self):
+        app = self.app
+        platform = app.get_platform('GCM')
+        platform.arn = 'modified'
+        self.assertIsNot(app.get_platform('GCM'), platform)
+        self.assertEqual(app.get_platform('GCM').arn, TEST_ARN_TOKEN_GCM)
+
+        topic = app.get_topic(TEST_TOPIC_NAME)
+        topic.arn = 'modified'
+        self.assertNotEqual(app.get_topic(TEST_TOPIC_NAME).arn, 'modified')
+
+    def test_topic_send(self):
+        self.topic.send(PushMessage(message=TEST_MESSAGE), self.connection)
+        with self.assertNumQueries(0):
+            self.topic.send(PushMessage(message=TEST_MESSAGE),
+                            self.connection)
+        self.assertEqual(self.connection.publish.call_count, 2)
+
+    def test_invalidation(self):
+        app = self.app
+        app.get_platform('GCM')
+
+        self.platform.arn = 'new_arn'
+        self.platform.save()
+        self.assertEqual(app.get_platform('GCM').arn, 'new_arn')
+
+        self.platform.delete()
+        with self.assertRaises(PlatformNotSupported):
+            app.get_platform('GCM')
+
+        app.name = 'renamed'
+        app.save()
+        self.assertEqual(self.topic.full_name, 'renamed_' + TEST_TOPIC_NAME)
+
+    def test_timeout(self):
+        app = self.app
+        with override_settings(SCARFACE_APPLICATION_CACHE_TIMEOUT=0):
+            app.get_platform('GCM')
+            with self.assertNumQueries(1):
+                app.get_platform('GCM')
+            with self.assertNumQueries(1):
+                self.assertEqual(self.topic.full_name,
+                                 TEST_APPLICATION_NAME + '_' + TEST_TOPIC_NAME)
+
+
+@override_settings(SCARFACE_LOGGING_ENABLED=False)
+class PayloadCacheTestCase(BaseTestCase):
+    def setUp(self):
+        payload_cache.clear()
+        app = self.application
+        self.platform = self.get_gcm_platform(app)
+        self.device = self.get_android_device(self.platform)
+        self.topic = self.get_topic(app)
+        self.connection = Mock()
+
+    def test_message_digest(self):
+        first = PushMessage(message=TEST_MESSAGE, extra_payload={'a': 1})
+        second = PushMessage(message=TEST_MESSAGE, extra_payload={'a': 1},
+                             receiver_arn='other')
+        self.assertEqual(message_digest(first), message_digest(second))
+        second.badge_count = 5
+        self.assertNotEqual(message_digest(first), message_digest(second))
+
+    def test_device_send(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        with patch.object(Platform, 'format_payload', autospec=True,
+                          return_value={'GCM': '{}'}) as format_payload:
+            for i in range(3):
+                self.device.send(message, self.connection)
+            message.message = 'changed'
+            self.device.send(message, self.connection)
+
+        self.assertEqual(format_payload.call_count, 2)
+        self.assertEqual((payload_cache.hits, payload_cache.misses), (2, 2))
+        self.assertEqual(
+            self.connection.publish.call_args_list[0][1]['message'],
+            '{"GCM":"{}"}'
+        )
+
+    def test_topic_send(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        with patch.object(Platform, 'format_payload', autospec=True,
+                          return_value={'GCM': '{}'}) as format_payload, \
+                patch('scarface.payload_cache.dumps',
+                      side_effect=dumps) as encode:
+            self.topic.send(message, self.connection)
+            self.topic.send(message, self.connection)
+
+        self.assertEqual(format_payload.call_count, 1)
+        self.assertEqual(encode.call_count, 2)
+        self.assertEqual((payload_cache.hits, payload_cache.misses), (1, 2))
+        self.assertEqual(
+            self.connection.publish.call_args_list[1][1]['message'],
+            dumps({'GCM': '{}', 'default': TEST_MESSAGE})
+        )
+
+    def test_digest_once(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        with patch('scarface.payload_cache.hashlib.sha256',
+                   side_effect=hashlib.sha256) as sha256:
+            self.device.send(message, self.connection)
+            payload = json.loads(json.loads(
+                self.connection.publish.call_args[1]['message'])['GCM'])
+            self.assertEqual(sha256.call_count, 1)
+            self.topic.send(message, self.connection)
+            self.assertEqual(sha256.call_count, 2)
+        self.assertEqual(payload['collapse_key'], message_digest(message))
+
+    @override_settings(SCARFACE_PAYLOAD_CACHE_SIZE=2)
+    def test_eviction(self):
+        messages = [PushMessage(message=str(i)) for i in range(3)]
+        for message in messages:
+            payload_cache.get(self.platform, message)
+        self.assertEqual(len(payload_cache), 2)
+
+        payload_cache.get(self.platform, messages[2])
+        payload_cache.get(self.platform, messages[0])
+        self.assertEqual((payload_cache.hits, payload_cache.misses), (1, 4))
+
+    @override_settings(SCARFACE_PAYLOAD_CACHE_SIZE=0)
+    def test_disabled(self):
+        message = PushMessage(message=TEST_MESSAGE)
+        payload_cache.get(self.platform, message)
+        payload_cache.get(self.platform, message)
+        self.assertEqual(len(payload_cache), 0)
+        self.assertEqual(payload_cache.misses, 2)
+
+
+def upper_dumps(obj):
+    return json.dumps(obj).upper()
+
+
+class SerializationTestCase(TestCase):
+    PAYLOAD = {'aps': {'alert': u'Grüße', 'badge': 1}, 'id': None}
+
+    EXPECTED = u'{"aps":{"alert":"Grüße","badge":1},"id":null}'
+
+    def test_backends(self):
+        for backend in ('auto', 'json'):
+            with override_settings(SCARFACE_JSON_BACKEND=backend):
+                self.assertEqual(dumps(self.PAYLOAD), self.EXPECTED)
+
+        with override_settings(
+                SCARFACE_JSON_BACKEND='scarface.tests.upper_dumps'):
+            self.assertEqual(dumps({'a': 'b'}), '{"A": "B"}')
+
+    @unittest.skipUnless(orjson, 'orjson is not installed')
+    @override_settings(SCARFACE_JSON_BACKEND='orjson')
+    def test_orjson(self):
+        self.assertEqual(dumps(self.PAYLOAD), self.EXPECTED)
+
+    @unittest.skipUnless(orjson, 'orjson is not installed')
+    @override_settings(SCARFACE_JSON_BACKEND='orjson')
+    def test_orjson_fallback(self):
+        self.assertEqual(dumps({1: 'a'}), '{"1":"a"}')
+
+
 class TestStrategy(PlatformStrategy):
     id = 'test'
     pass
 
 
+
+class BadgeStrategy(PlatformStrategy):
+    id = 'BADGE'
+
+    def format_payload(self, message):
+        return super(BadgeStrategy, self).format_payload(
+            {'badge': message.badge_count}
+        )
+
+
 class StrategyImportTestCase(TestCase):
     def test_get_strategies(self):
         strategies = get_strategies()
         self.assertEqual(len(strategies),
                          len(SCARFACE_DEFAULT_PLATFORM_STRATEGIES))
 
+    @override_settings(
+        SCARFACE_PLATFORM_STRATEGIES=['scarface.tests.TestStrategy']
+    )
     def test_get_strategies_custom(self):
         from django.conf import settings
-        settings.SCARFACE_PLATFORM_STRATEGIES = [
-            'scarface.tests.TestStrategy'
-        ]
         strategies = get_strategies()
         self.assertEqual(
                 len(strategies),
@@ -598,6 +2138,26 @@ class StrategyImportTestCase(TestCase):
                 )
         )
 
+    def test_get_strategies_cached(self):
+        strategies = get_strategies()
+        with patch('scarface.platform_strategy.import_string') as imp:
+            self.assertIs(get_strategies(), strategies)
+            self.assertFalse(imp.called)
+
+        with override_settings(
+                SCARFACE_PLATFORM_STRATEGIES=['scarface.tests.TestStrategy']
+        ):
+            self.assertIn(TestStrategy.id, get_strategies())
+        self.assertNotIn(TestStrategy.id, get_strategies())
+
+    def test_platform_strategy_cached(self):
+        platform = Platform(platform='APNS')
+        strategy = platform.strategy
+        self.assertIs(platform.strategy, strategy)
+
+        platform.platform = 'GCM'
+        self.assertIsInstance(platform.strategy, GCMPlatformStrategy)
+
 
 class StrategyTestCase(TestCase):
     def test_extra_apns(self):
@@ -621,6 +2181,100 @@ class StrategyTestCase(TestCase):
             'mutable-content': 1})
 
 
+    def test_truncate_utf8(self):
+        self.assertEqual(truncate_utf8(u'short', 10), u'short')
+        self.assertEqual(truncate_utf8(u'abcdefghij', 8), u'abcde...')
+        # 'ä' takes two bytes and is not cut in half
+        self.assertEqual(truncate_utf8(u'aäää', 5), u'a...')
+        self.assertEqual(truncate_utf8(u'abc', 2), u'')
+
+    @override_settings(SCARFACE_MESSAGE_TRIM_LENGTH=10)
+    def test_trim_message(self):
+        apns = APNPlatformStrategy(Mock())
+        trimmed = apns.trim_message(u'\U0001F600' * 10)
+        self.assertEqual(trimmed, u'\U0001F600...')
+        self.assertLessEqual(len(trimmed.encode('utf-8')), 10)
+
+    @override_settings(SCARFACE_MESSAGE_TRIM_LENGTH=10 ** 6)
+    def test_max_payload_bytes(self):
+        platform = Mock()
+        platform.platform = 'APNS'
+        apns = APNPlatformStrategy(platform)
+        message = PushMessage(message=u'ä' * 5000)
+
+        payload = apns.format_payload(message)['APNS']
+        self.assertLessEqual(len(payload.encode('utf-8')), 4096)
+        alert = json.loads(payload)['aps']['alert']
+        self.assertTrue(alert.endswith('...'))
+        # One more character would exceed the limit
+        self.assertGreater(len(payload.encode('utf-8')) + 6, 4096)
+
+        gcm = GCMPlatformStrategy(platform)
+        payload = gcm.format_payload(message)['APNS']
+        self.assertLessEqual(len(payload.encode('utf-8')), 4096)
+
+        message = PushMessage(message=u'Hello',
+                              extra_payload={'data': 'x' * 5000})
+        with self.assertRaises(PayloadTooLarge):
+            apns.format_payload(message)
+
+
+    def test_gcm_collapse_key(self):
+        platform = Mock()
+        platform.platform = 'GCM'
+        gcm = GCMPlatformStrategy(platform)
+
+        def collapse_key(message):
+            return json.loads(gcm.format_payload(message)['GCM'])[
+                'collapse_key']
+
+        message = PushMessage(message=TEST_MESSAGE,
+                              extra_payload={'nested': {'a': [1, 2]}})
+        key = collapse_key(message)
+        self.assertEqual(key, message_digest(message))
+        self.assertEqual(
+            key,
+            collapse_key(PushMessage(message=TEST_MESSAGE,
+                                     extra_payload={'nested': {'a': [1, 2]}}))
+        )
+        self.assertNotEqual(key, collapse_key(PushMessage(message='other')))
+        self.assertEqual(
+            gcm.build_payload(message, digest='known')['collapse_key'],
+            'known'
+        )
+
+        message.collapse_key = 'news'
+        self.assertEqual(collapse_key(message), 'news')
+
+    def test_compile(self):
+        platform = Mock()
+        platform.platform = 'APNS'
+        apns = APNPlatformStrategy(platform)
+        message = PushMessage(message=u'Grüße "quoted"', badge_count=2,
+                              extra_payload={'ref': 'x'})
+        expected = dumps(apns.format_payload(message))
+
+        self.assertEqual(apns.compile(message).render(), expected)
+        template = apns.compile(message, ('badge',))
+        self.assertEqual(len(template.segments), 2)
+        self.assertEqual(template.render(), expected)
+
+        message.badge_count = 9
+        self.assertEqual(template.render(badge=9),
+                         dumps(apns.format_payload(message)))
+
+    def test_compile_without_build_payload(self):
+        platform = Mock()
+        platform.platform = 'BADGE'
+        strategy = BadgeStrategy(platform)
+        template = strategy.compile(PushMessage(message=TEST_MESSAGE),
+                                    ('badge',))
+
+        self.assertIsInstance(template, FormattingTemplate)
+        self.assertEqual(template.render(badge=3),
+                         dumps({'BADGE': dumps({'badge': 3})}))
+
+
 @DefaultConnection
 def connection_test(a=None, connection=None):
     return a, connection
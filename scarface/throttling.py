@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Client side rate limiting of the SNS API. SCARFACE_RATE_LIMITS maps API
+actions to the number of requests per second, e.g.
+
+    SCARFACE_RATE_LIMITS = {
+        'Publish': 30,
+        'CreatePlatformEndpoint': (10, 20),
+    }
+
+A tuple sets the rate and the burst size. Every region and action gets its
+own token bucket which is shared by all threads of the process. Actions
+without a limit are not throttled.
+
+With SCARFACE_RATE_LIMIT_BACKEND = 'cache' the limits apply to all
+processes sharing the cache SCARFACE_RATE_LIMIT_CACHE. The budget of every
+second is counted in the cache and handed out in leases of up to
+SCARFACE_RATE_LIMIT_LEASE tokens, so most calls don't touch the cache. The
+cache backend has no burst size, limits must be plain rates.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from scarface.settings import SCARFACE_DEFAULT_RATE_LIMITS, \
+    SCARFACE_DEFAULT_RATE_LIMIT_BACKEND, SCARFACE_DEFAULT_RATE_LIMIT_CACHE, \
+    SCARFACE_DEFAULT_RATE_LIMIT_LEASE
+
+__author__ = 'dreipol GmbH'
+
+RATE_LIMIT_BACKEND_LOCAL = 'local'
+RATE_LIMIT_BACKEND_CACHE = 'cache'
+
+_lock = threading.Lock()
+_buckets = dict()
+
+
+def rate_limits():
+    return getattr(
+        settings,
+        'SCARFACE_RATE_LIMITS',
+        SCARFACE_DEFAULT_RATE_LIMITS
+    )
+
+
+def rate_limit_backend():
+    return getattr(
+        settings,
+        'SCARFACE_RATE_LIMIT_BACKEND',
+        SCARFACE_DEFAULT_RATE_LIMIT_BACKEND
+    )
+
+
+def rate_limit_cache():
+    return getattr(
+        settings,
+        'SCARFACE_RATE_LIMIT_CACHE',
+        SCARFACE_DEFAULT_RATE_LIMIT_CACHE
+    )
+
+
+def rate_limit_lease():
+    return getattr(
+        settings,
+        'SCARFACE_RATE_LIMIT_LEASE',
+        SCARFACE_DEFAULT_RATE_LIMIT_LEASE
+    )
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average and bursts of up to
+    capacity requests. Callers which exceed the rate reserve their tokens
+    in advance and sleep until they are due, so waiting callers are served
+    in order.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity or rate, 1))
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Takes tokens from the bucket, even if it is empty.
+        :return: seconds to wait until the tokens are available
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class CacheTokenBucket(object):
+    """
+    Allows rate requests per second across all processes using the same
+    cache. Every second has its own counter in the cache, tokens are leased
+    from it in batches and expire with the second they were leased for.
+    The burst size is the rate.
+
+    The first lease of a second is a single token, every further lease is
+    as large as the tokens used so far in that second, up to lease. A
+    process leases few tokens it doesn't use, even when many processes
+    share a small rate.
+    """
+
+    def __init__(self, key, rate, lease=None, cache=None, clock=time.time):
+        self.key = key
+        self.rate = max(int(rate), 1)
+        self.lease = max(min(lease or rate_limit_lease(), self.rate), 1)
+        self.cache = caches[cache or rate_limit_cache()]
+        self.clock = clock
+        self.window = None
+        self.tokens = 0
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, window, count):
+        """
+        Leases up to count tokens of a window from the cache.
+        :return: number of leased tokens
+        """
+        key = u'{0}:{1}'.format(self.key, window)
+        if self.cache.add(key, count, timeout=2):
+            used = count
+        else:
+            try:
+                used = self.cache.incr(key, count)
+            except ValueError:
+                # The counter expired in between
+                self.cache.set(key, count, timeout=2)
+                used = count
+        return max(min(count, self.rate - used + count), 0)
+
+    def acquire(self, tokens=1):
+        waited = 0
+        while True:
+            with self._lock:
+                now = self.clock()
+                window = int(now)
+                if window != self.window:
+                    self.window = window
+                    self.tokens = 0
+                    self.used = 0
+                if self.tokens < tokens:
+                    lease = max(min(self.used, self.lease), 1)
+                    self.tokens += self.take(
+                        window, max(lease, tokens - self.tokens)
+                    )
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.used += tokens
+                    return waited
+                wait = window + 1 - now
+            time.sleep(wait)
+            waited += wait
+
+
+def create_bucket(region, action, limit):
+    if not isinstance(limit, (tuple, list)):
+        limit = (limit,)
+    if rate_limit_backend() == RATE_LIMIT_BACKEND_CACHE:
+        if len(limit) > 1:
+            raise ImproperlyConfigured(
+                u'SCARFACE_RATE_LIMITS: the cache backend has no burst size, '
+                u'set the rate of {0} only'.format(action)
+            )
+        return CacheTokenBucket(
+            u'scarface:ratelimit:{0}:{1}'.format(region, action), limit[0]
+        )
+    return TokenBucket(*limit)
+
+
+def get_bucket(region, action):
+    """
+    Returns the bucket of an action in a region or None if the action
+    isn't limited.
+    :rtype: TokenBucket or CacheTokenBucket
+    """
+    key = (region, action)
+    with _lock:
+        if key not in _buckets:
+            limit = rate_limits().get(action)
+            _buckets[key] = create_bucket(region, action, limit) \
+                if limit else None
+        return _buckets[key]
+
+
+def throttle(region, action):
+    """
+    Blocks until the action may be called in the region.
+    :return: seconds waited
+    """
+    bucket = get_bucket(region, action)
+    if bucket is None:
+        return 0
+    return bucket.acquire()
+
+
+@receiver(setting_changed)
+def reset_buckets(setting, **kwargs):
+    if setting in ('SCARFACE_RATE_LIMITS', 'SCARFACE_RATE_LIMIT_BACKEND',
+                   'SCARFACE_RATE_LIMIT_CACHE', 'SCARFACE_RATE_LIMIT_LEASE'):
+        with _lock:
+            _buckets.clear()
@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
 import inspect
-from functools import partial
+import threading
+from contextlib import contextmanager
+from itertools import islice
+from types import MethodType
 
 from boto import sns
 from django.conf import settings
 
+from scarface import push_log
+from scarface.connection import ScarfaceSNSConnection
+from scarface.settings import SCARFACE_DEFAULT_BULK_CHUNK_SIZE, \
+    SCARFACE_DEFAULT_BULK_MAX_WORKERS, SCARFACE_DEFAULT_CONNECTION_POOL_SIZE, \
+    SCARFACE_DEFAULT_ASYNC_MAX_CONCURRENCY, \
+    SCARFACE_DEFAULT_OUTBOX_MAX_ATTEMPTS, SCARFACE_DEFAULT_OUTBOX_RETRY_DELAY, \
+    SCARFACE_DEFAULT_OUTBOX_LEASE, SCARFACE_DEFAULT_DEREGISTER_ON_COMMIT
+
 __author__ = 'dreipol GmbH'
 
 
 class Decorator(object):
     def __init__(self, function, *args, **kwargs):
         self.function = function
+        # Bind the signature once instead of inspecting it on every call
+        self.parameters = list(
+            inspect.signature(self.original_function).parameters
+        )
 
     @property
     def original_function(self):
@@ -19,42 +34,61 @@ class Decorator(object):
             function = function.function
         return function
 
-
-class DefaultConnection(Decorator):
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self.function
-        return partial(self, obj)
+        return MethodType(self, obj)
+
+
+class DefaultConnection(Decorator):
+    def __init__(self, function, *args, **kwargs):
+        super(DefaultConnection, self).__init__(function, *args, **kwargs)
+        self.connection_index = self.parameters.index('connection')
+        self.is_generator = inspect.isgeneratorfunction(
+            self.original_function
+        )
 
     def __call__(self, *args, **kwargs):
-        connection_keyword = 'connection'
-        if len(args) + len(kwargs) == 0:
-            call_kwargs = dict()
+        index = self.connection_index
+        if kwargs.get('connection') or (len(args) > index and args[index]):
+            return self.function(*args, **kwargs)
+        if self.is_generator:
+            return self.generate(args, kwargs)
+        with connection_manager.connection() as connection:
+            args, kwargs = self.bind(args, kwargs, connection)
+            return self.function(*args, **kwargs)
+
+    def bind(self, args, kwargs, connection):
+        index = self.connection_index
+        if len(args) > index:
+            args = args[:index] + (connection,) + args[index + 1:]
         else:
-            call_kwargs = inspect.getcallargs(
-                self.original_function,
-                *args,
-                **kwargs
-            )
-        if not call_kwargs.get(connection_keyword, None):
-            call_kwargs[connection_keyword] = get_sns_connection()
-        return self.function(**call_kwargs)
+            kwargs['connection'] = connection
+        return args, kwargs
+
+    def generate(self, args, kwargs):
+        """
+        Keeps the default connection until the generator is exhausted or
+        closed.
+        """
+        with connection_manager.connection() as connection:
+            args, kwargs = self.bind(args, kwargs, connection)
+            yield from self.function(*args, **kwargs)
 
 
 class PushLogger(Decorator):
-    def __get__(self, obj, objtype=None):
-        if obj is None:
-            return self.function
-        self.obj = obj
-        return partial(self, obj)
+    def __init__(self, function, *args, **kwargs):
+        super(PushLogger, self).__init__(function, *args, **kwargs)
+        self.push_message_index = self.parameters.index('push_message')
 
     def __call__(self, *args, **kwargs):
-        call_kwargs = inspect.getcallargs(self.original_function, *args,
-            **kwargs)
-        push_message = call_kwargs.get('push_message')
-        self.obj.sign(push_message)
+        if 'push_message' in kwargs:
+            push_message = kwargs['push_message']
+        else:
+            push_message = args[self.push_message_index]
+        args[0].sign(push_message)
         if logging_enabled():
-            push_message.save()
+            push_log.log(push_message)
         return self.function(*args, **kwargs)
 
 
@@ -64,17 +98,208 @@ def get_sns_connection():
     :param region: the region of the DynamoDB, defaults to Ireland
     :return: a new dynamodb2 connection
     """
+    return connect(*connection_key())
 
+
+def connect(region, access_key, secret_key):
+    """
+    Returns a ScarfaceSNSConnection to the region or None if the region
+    doesn't exist.
+    """
+    for region_info in sns.regions():
+        if region_info.name == region:
+            return ScarfaceSNSConnection(
+                region=region_info, aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key
+            )
+    return None
+
+
+def connection_key():
+    """
+    Returns the region and credentials a connection is created for.
+    """
     region = settings.SCARFACE_REGION_NAME if hasattr(settings, "SCARFACE_REGION_NAME") else 'eu-west-1'
+    return (
+        region,
+        settings.AWS_ACCESS_KEY,
+        settings.AWS_SECRET_ACCESS_KEY
+    )
 
-    return sns.connect_to_region(
-        region, aws_access_key_id=settings.AWS_ACCESS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+
+def connection_pool_size():
+    return getattr(
+        settings,
+        'SCARFACE_CONNECTION_POOL_SIZE',
+        SCARFACE_DEFAULT_CONNECTION_POOL_SIZE
     )
 
 
+class ConnectionManager(object):
+    """
+    Keeps SNS connections per region and credentials so that their
+    keep-alive HTTP connections are reused. A connection is handed out to
+    one caller at a time, at most SCARFACE_CONNECTION_POOL_SIZE idle
+    connections are kept per key.
+    """
+
+    def __init__(self, factory=None):
+        self.factory = factory or connect
+        self._lock = threading.Lock()
+        self._idle = dict()
+        self._checked_out = dict()
+        self._generation = 0
+
+    def acquire(self):
+        """
+        Returns an idle connection or creates a new one. Pass it back
+        with release() once you are done.
+        """
+        key = connection_key()
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+            generation = self._generation
+        if connection is None:
+            connection = self.factory(*key)
+        with self._lock:
+            self._checked_out[id(connection)] = (key, generation)
+        return connection
+
+    def release(self, connection):
+        """
+        Returns the connection to the pool. It is closed if the pool is full
+        or has been reset in the meantime.
+        """
+        with self._lock:
+            key, generation = self._checked_out.pop(id(connection))
+            idle = self._idle.setdefault(key, list())
+            if generation == self._generation and \
+                    len(idle) < connection_pool_size():
+                idle.append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def reset(self):
+        """
+        Closes all idle connections. Connections in use are closed once they
+        are released.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+            self._generation += 1
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def close(self):
+        """
+        Closes all pooled connections, e.g. before forking a worker process.
+        """
+        self.reset()
+
+
+connection_manager = ConnectionManager()
+
+
 def logging_enabled():
     return settings.SCARFACE_LOGGING_ENABLED if hasattr(
         settings,
         'SCARFACE_LOGGING_ENABLED'
     ) else True
+
+
+def bulk_chunk_size():
+    return getattr(
+        settings,
+        'SCARFACE_BULK_CHUNK_SIZE',
+        SCARFACE_DEFAULT_BULK_CHUNK_SIZE
+    )
+
+
+def bulk_max_workers():
+    return getattr(
+        settings,
+        'SCARFACE_BULK_MAX_WORKERS',
+        SCARFACE_DEFAULT_BULK_MAX_WORKERS
+    )
+
+
+def async_max_concurrency():
+    return getattr(
+        settings,
+        'SCARFACE_ASYNC_MAX_CONCURRENCY',
+        SCARFACE_DEFAULT_ASYNC_MAX_CONCURRENCY
+    )
+
+
+def outbox_max_attempts():
+    return getattr(
+        settings,
+        'SCARFACE_OUTBOX_MAX_ATTEMPTS',
+        SCARFACE_DEFAULT_OUTBOX_MAX_ATTEMPTS
+    )
+
+
+def outbox_retry_delay():
+    return getattr(
+        settings,
+        'SCARFACE_OUTBOX_RETRY_DELAY',
+        SCARFACE_DEFAULT_OUTBOX_RETRY_DELAY
+    )
+
+
+def outbox_lease():
+    return getattr(
+        settings,
+        'SCARFACE_OUTBOX_LEASE',
+        SCARFACE_DEFAULT_OUTBOX_LEASE
+    )
+
+
+def deregister_on_commit():
+    return getattr(
+        settings,
+        'SCARFACE_DEREGISTER_ON_COMMIT',
+        SCARFACE_DEFAULT_DEREGISTER_ON_COMMIT
+    )
+
+
+def chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most size elements without
+    materializing the whole iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def chunked_by_pk(queryset, size, *fields):
+    """
+    Yields lists of (pk, *fields) tuples ordered by primary key. Every chunk
+    is a separate query which starts after the last primary key, so the
+    table may be modified between the chunks.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk_queryset = queryset
+        if last_pk is not None:
+            chunk_queryset = queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset.values_list('pk', *fields)[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1][0]